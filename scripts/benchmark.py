@@ -0,0 +1,462 @@
+"""
+Benchmark suite of the annotation stages on synthetic, seeded data.
+
+Generators write sniffles style vcfs, formated rmsk tables and outfmt 6
+blast reports of a given number of records. Each benchmark is timed (best of
+--repeat runs) and run once more under tracemalloc for its peak python
+memory. Results are written as json, so runs can be compared offline with
+--compare.
+
+python3 scripts/benchmark.py --scales 1000,10000,100000 -o bench.json
+python3 scripts/benchmark.py --scales 1000,10000,100000 --compare bench.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+import resource
+import tracemalloc
+import importlib.util
+
+import bin_index
+import sv_vcf
+import vcf_table
+import del_mei_annot
+import ins_seq_annot
+
+CHROMS = [str(i) for i in range(1, 23)] + ["X", "Y"]
+# repName of generated rmsk records and their weights, most are not MEI
+REP_NAMES = (("AluY", 10), ("AluSx", 10), ("L1HS", 4), ("L1PA2", 4),
+    ("SVA_D", 1), ("MIR", 20), ("(CA)n", 20), ("THE1B", 10), ("L2a", 21))
+REP_SIZES = {"Alu": (280, 320), "L1": (500, 6100), "SVA": (900, 2500)}
+# blast db sequence names, family is the part before the first dot
+SUBJECTS = (("Alu.Y", 290), ("Alu.Sx", 310), ("L1.HS", 6000),
+    ("SVA.D", 2000), ("HBV.AB1", 3215), ("HPV.16", 7906))
+
+
+def _load_annot():
+    """
+    mei_virals.annot.py is not importable by name
+    """
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "mei_virals.annot.py")
+    spec = importlib.util.spec_from_file_location("mei_virals_annot", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def _chrom_weights():
+    # roughly chromosome sizes, 1 is about 10x Y
+    return [max(1, 25 - i) for i in range(len(CHROMS))]
+
+
+def gen_rmsk(path, n, seed=1):
+    """
+    formated rmsk table of n records, coordinate sorted, return the
+    (chrom, start, end, repName) of each record
+    """
+    r = random.Random(seed)
+    names = [i[0] for i in REP_NAMES]
+    name_weights = [i[1] for i in REP_NAMES]
+    counts = dict((i, 0) for i in CHROMS)
+    for chrom in r.choices(CHROMS, _chrom_weights(), k=n):
+        counts[chrom] += 1
+    rows = []
+    for chrom in CHROMS:
+        pos = 10000
+        for name in r.choices(names, name_weights, k=counts[chrom]):
+            pos += r.randint(50, 3000)
+            family = name[:3] if name[:3] in ("Alu", "SVA") else name[:2]
+            size = r.randint(*REP_SIZES.get(family, (20, 400)))
+            rows.append(("chr"+chrom, pos, pos+size, name))
+    with open(path, "w") as out_fp:
+        print("#rmsk_id\t#bin\tswScore\tmilliDiv\tmilliDel\tmilliIns\t"
+            "genoName\tgenoStart\tgenoEnd\tgenoLeft\tstrand\trepName\t"
+            "repClass\trepFamily\trepStart\trepEnd\trepLeft\tid",
+            file=out_fp)
+        for n, (chrom, start, end, name) in enumerate(rows):
+            print("rmsk_{}\t585\t{}\t{}\t0\t0\t{}\t{}\t{}\t-1\t+\t{}\tSINE\t"
+                "{}\t1\t{}\t0\t{}".format(n, r.randint(200, 3000),
+                r.randint(0, 300), chrom, start, end, name, name[:3],
+                end-start, n), file=out_fp)
+    return rows
+
+
+def _info(chrom2, end, svtype, svlen):
+    return ("PRECISE;SVMETHOD=Snifflesv1.0.10;CHR2={};END={};"
+        "STD_quant_start=0.0;STD_quant_stop=0.0;Kurtosis_quant_start=0.0;"
+        "Kurtosis_quant_stop=0.0;SVTYPE={};SUPTYPE=AL;SVLEN={};"
+        "STRANDS=+-;RE=8;REF_strand=4,4;AF=0.5;RNAMES=read1,read2,"
+        "read3".format(chrom2, end, svtype, svlen))
+
+
+def gen_vcf(path, n, rmsk_rows, seed=2):
+    """
+    sniffles style vcf of n records, 45% DEL, 35% INS, rest DUP, INV and
+    BND. Half of the DELs are placed on rmsk records with a small breakpoint
+    jitter.
+    """
+    r = random.Random(seed)
+    bases = "ACGT"
+    records = []
+    for i in range(n):
+        t = r.random()
+        chrom = r.choices(CHROMS, _chrom_weights())[0]
+        pos = r.randint(10000, 200000000)
+        if t < 0.45:
+            if rmsk_rows and r.random() < 0.5:
+                chrom, start, end, name = r.choice(rmsk_rows)
+                chrom = chrom[3:]
+                pos = start + r.randint(-10, 10)
+                end = end + r.randint(-10, 10)
+            else:
+                end = pos + r.randint(50, 12000)
+            records.append((chrom, pos, "N", "<DEL>",
+                _info(chrom, end, "DEL", pos-end)))
+        elif t < 0.8:
+            seq = "".join(r.choices(bases, k=r.randint(50, 500)))
+            records.append((chrom, pos, "N", "N"+seq,
+                _info(chrom, pos+1, "INS", len(seq))))
+        elif t < 0.9:
+            end = pos + r.randint(100, 50000)
+            records.append((chrom, pos, "N", "<DUP>",
+                _info(chrom, end, "DUP", end-pos)))
+        elif t < 0.95:
+            end = pos + r.randint(100, 50000)
+            records.append((chrom, pos, "N", "<INV>",
+                _info(chrom, end, "INV", end-pos)))
+        else:
+            chrom2 = r.choice(CHROMS)
+            pos2 = r.randint(10000, 200000000)
+            records.append((chrom, pos, "N", "N[{}:{}[".format(chrom2, pos2),
+                _info(chrom2, pos2, "BND", 0)))
+    order = dict((j, i) for i, j in enumerate(CHROMS))
+    records.sort(key=lambda x: (order[x[0]], x[1]))
+    with open(path, "w") as out_fp:
+        print("##fileformat=VCFv4.2\n##source=Sniffles", file=out_fp)
+        for chrom in CHROMS:
+            print("##contig=<ID={},length=250000000>".format(chrom),
+                file=out_fp)
+        print("#CHROM\tPOS\tID\tREF\tALT\tQUAL\tFILTER\tINFO\tFORMAT\t"
+            "sample", file=out_fp)
+        for i, (chrom, pos, ref, alt, info) in enumerate(records):
+            print("{}\t{}\t{}\t{}\t{}\t.\tPASS\t{}\tGT:DR:DV\t0/1:4:8".format(
+                chrom, pos, i, ref, alt, info), file=out_fp)
+
+
+def gen_blast_report(path, n, seed=3):
+    """
+    outfmt 6 report of n lines, queries have 1-4 subjects with 1-5 hsps
+    """
+    r = random.Random(seed)
+    lines = 0
+    query = 0
+    with open(path, "w") as out_fp:
+        while lines < n:
+            qlen = r.randint(50, 6000)
+            for saccver, slen in r.sample(SUBJECTS, r.randint(1, 4)):
+                for k in range(r.randint(1, 5)):
+                    if lines >= n:
+                        break
+                    qstart = r.randint(1, qlen)
+                    qend = r.randint(qstart, qlen)
+                    length = qend - qstart + 1
+                    sstart = r.randint(1, slen)
+                    send = min(slen, sstart + length - 1)
+                    sstrand = "plus"
+                    if r.random() < 0.5:
+                        sstart, send = send, sstart
+                        sstrand = "minus"
+                    print("ins{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{}\t{:.3f}\t{}\t"
+                        "{}\t{}\t{:.2e}\t{:.1f}".format(query, saccver, qlen,
+                        slen, qstart, qend, sstart, send, sstrand,
+                        r.uniform(70, 100), length, r.randint(0, 20),
+                        r.randint(0, 5), r.uniform(0, 1e-10),
+                        r.uniform(50, 5000)), file=out_fp)
+                    lines += 1
+            query += 1
+
+
+class bench_data(object):
+    """
+    generated files of one scale in workdir
+    """
+    def __init__(self, workdir, scale, seed):
+        self.scale = scale
+        self.rmsk = os.path.join(workdir, "rmsk.{}.db".format(scale))
+        self.vcf = os.path.join(workdir, "sv.{}.vcf".format(scale))
+        self.report = os.path.join(workdir, "blast.{}.txt".format(scale))
+        rows = gen_rmsk(self.rmsk, scale, seed)
+        gen_vcf(self.vcf, scale, rows, seed+1)
+        gen_blast_report(self.report, scale, seed+2)
+        self.intervals = [bin_index.interval(i[1], i[2], i[0]) for i in rows]
+        self.queries = []
+        for chrom, q in del_mei_annot.del_reader(self.vcf):
+            self.queries.append((chrom, q))
+        with open(self.vcf) as io:
+            self.lines = [i for i in io if i[0] != "#"]
+
+
+# every benchmark takes a bench_data and returns the number of items done
+def bench_bin_index_build_db(data, index_class=bin_index.BinIndex):
+    index_class().build_db(data.intervals)
+    return len(data.intervals)
+
+
+def bench_bin_index_get_overlap(data, index_class=bin_index.BinIndex):
+    index = index_class()
+    index.build_db(data.intervals)
+    queries = [i for chrom, i in data.queries]
+    start = time.perf_counter()
+    for q in queries:
+        index.get_overlap(q)
+    return len(queries), time.perf_counter() - start
+
+
+def bench_compact_bin_index_build_db(data):
+    return bench_bin_index_build_db(data, bin_index.CompactBinIndex)
+
+
+def bench_compact_bin_index_get_overlap(data):
+    return bench_bin_index_get_overlap(data, bin_index.CompactBinIndex)
+
+
+def bench_rmsk_loadDB(data):
+    _rmsk_db = del_mei_annot.rmsk_db()
+    _rmsk_db.loadDB(data.rmsk, cache=False)
+    for chrom in _rmsk_db.chroms:
+        _rmsk_db.get_index(chrom)
+    return data.scale
+
+
+def bench_rmsk_loadDB_cached(data):
+    # cache is built by the first untimed call
+    _rmsk_db = del_mei_annot.rmsk_db()
+    _rmsk_db.loadDB(data.rmsk)
+    for chrom in _rmsk_db.chroms:
+        _rmsk_db.get_index(chrom)
+    return data.scale
+
+
+def bench_rmsk_search(data):
+    _rmsk_db = del_mei_annot.rmsk_db()
+    _rmsk_db.loadDB(data.rmsk)
+    for chrom in _rmsk_db.chroms:
+        _rmsk_db.get_index(chrom)
+    start = time.perf_counter()
+    for chrom, q in data.queries:
+        _rmsk_db.search(chrom, q)
+    return len(data.queries), time.perf_counter() - start
+
+
+def bench_rmsk_search_batch(data):
+    _rmsk_db = del_mei_annot.rmsk_db()
+    _rmsk_db.loadDB(data.rmsk)
+    queries = dict()
+    for chrom, q in data.queries:
+        queries.setdefault(chrom, []).append(q)
+    for chrom in _rmsk_db.chroms:
+        _rmsk_db.get_index(chrom)
+    start = time.perf_counter()
+    for chrom in queries:
+        _rmsk_db.search_batch(chrom, queries[chrom])
+    return len(data.queries), time.perf_counter() - start
+
+
+def bench_rmsk_search_breakpoints(data):
+    _rmsk_db = del_mei_annot.rmsk_db()
+    _rmsk_db.loadDB(data.rmsk)
+    queries = dict()
+    for chrom, q in data.queries:
+        queries.setdefault(chrom, []).append(q)
+    for chrom in _rmsk_db.chroms:
+        _rmsk_db.get_breakpoints(chrom)
+    start = time.perf_counter()
+    for chrom in queries:
+        _rmsk_db.search_breakpoints(chrom, queries[chrom])
+    return len(data.queries), time.perf_counter() - start
+
+
+def bench_sv_vcf_record(data):
+    for line in data.lines:
+        sv_vcf.sv_vcf_record(line)
+    return len(data.lines)
+
+
+def bench_lazy_sv_vcf_record(data):
+    for line in data.lines:
+        sv = sv_vcf.lazy_sv_vcf_record(line)
+        sv.svtype, sv.pos2
+    return len(data.lines)
+
+
+def bench_vcf_table(data):
+    vcf_table.vcf_table(data.vcf)
+    return len(data.lines)
+
+
+def bench_get_best_hit(data):
+    n = 0
+    for report in ins_seq_annot.report_reader(data.report):
+        ins_seq_annot.get_best_hit(ins_seq_annot.hit_iter(report))
+        n += len(report)
+    return n
+
+
+def bench_best_hit_iter(data):
+    for fields in ins_seq_annot.best_hit_iter(data.report):
+        pass
+    return data.scale
+
+
+def bench_reporter(data):
+    annot = _load_annot()
+    table = vcf_table.vcf_table(data.vcf)
+    families = ["Alu", "L1", "SVA", "HBV"]
+    del_annot_dict = dict((j, families[i % 3]) for i, j in
+        enumerate(table.ids[::3]))
+    ins_annot_dict = dict((j, families[i % 4]) for i, j in
+        enumerate(table.ids[1::3]))
+    output = data.report + ".annot"
+    start = time.perf_counter()
+    annot.reporter(table, del_annot_dict, ins_annot_dict, output)
+    return len(table), time.perf_counter() - start
+
+
+BENCHMARKS = [
+    ("bin_index.build_db", bench_bin_index_build_db),
+    ("bin_index.get_overlap", bench_bin_index_get_overlap),
+    ("bin_index.compact.build_db", bench_compact_bin_index_build_db),
+    ("bin_index.compact.get_overlap", bench_compact_bin_index_get_overlap),
+    ("rmsk_db.loadDB", bench_rmsk_loadDB),
+    ("rmsk_db.loadDB_cached", bench_rmsk_loadDB_cached),
+    ("rmsk_db.search", bench_rmsk_search),
+    ("rmsk_db.search_batch", bench_rmsk_search_batch),
+    ("rmsk_db.search_breakpoints", bench_rmsk_search_breakpoints),
+    ("sv_vcf.sv_vcf_record", bench_sv_vcf_record),
+    ("sv_vcf.lazy_sv_vcf_record", bench_lazy_sv_vcf_record),
+    ("vcf_table.vcf_table", bench_vcf_table),
+    ("ins_seq_annot.get_best_hit", bench_get_best_hit),
+    ("ins_seq_annot.best_hit_iter", bench_best_hit_iter),
+    ("mei_virals.annot.reporter", bench_reporter),
+]
+
+
+def run_one(func, data, repeat):
+    """
+    best seconds of repeat runs, items and tracemalloc peak bytes. A
+    benchmark may return (items, seconds) to time only its measured part.
+    """
+    func(data) # warm up, builds caches
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        result = func(data)
+        seconds = time.perf_counter() - start
+        if isinstance(result, tuple):
+            items, seconds = result
+        else:
+            items = result
+        if best is None or seconds < best:
+            best = seconds
+    tracemalloc.start()
+    func(data)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return items, best, peak
+
+
+def run_benchmarks(scales, repeat=3, seed=1, only=None, workdir=None,
+    log_fp=sys.stderr):
+    results = []
+    if workdir is not None:
+        os.makedirs(workdir, exist_ok=True)
+    tmpdir = tempfile.mkdtemp(prefix="mei_bench.", dir=workdir)
+    try:
+        for scale in scales:
+            data = bench_data(tmpdir, scale, seed)
+            for name, func in BENCHMARKS:
+                if only and not any(i in name for i in only):
+                    continue
+                items, seconds, peak = run_one(func, data, repeat)
+                results.append({"name": name, "scale": scale, "items": items,
+                    "seconds": seconds,
+                    "items_per_second": items/seconds if seconds else None,
+                    "peak_bytes": peak})
+                print("[benchmark] {}\t{}\t{:.4f} s\t{:.0f} items/s\t{:.1f} "
+                    "MB".format(name, scale, seconds,
+                    results[-1]["items_per_second"] or 0, peak/2**20),
+                    file=log_fp)
+    finally:
+        shutil.rmtree(tmpdir)
+    return {"meta": {"python": platform.python_version(),
+        "platform": platform.platform(), "time": time.strftime(
+        "%Y-%m-%dT%H:%M:%S"), "seed": seed, "repeat": repeat,
+        "scales": scales, "max_rss_kb": resource.getrusage(
+        resource.RUSAGE_SELF).ru_maxrss}, "results": results}
+
+
+def compare(old, new, out_fp=sys.stdout):
+    """
+    speedup of new over old for each benchmark and scale in both
+    """
+    old_results = dict(((i["name"], i["scale"]), i) for i in old["results"])
+    print("#name\tscale\told_seconds\tnew_seconds\tspeedup\told_peak_MB\t"
+        "new_peak_MB", file=out_fp)
+    for i in new["results"]:
+        j = old_results.get((i["name"], i["scale"]))
+        if j is None:
+            continue
+        print("{}\t{}\t{:.4f}\t{:.4f}\t{:.2f}\t{:.1f}\t{:.1f}".format(
+            i["name"], i["scale"], j["seconds"], i["seconds"],
+            j["seconds"]/i["seconds"] if i["seconds"] else 0,
+            j["peak_bytes"]/2**20, i["peak_bytes"]/2**20), file=out_fp)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Benchmark annotation"
+        " stages on synthetic data", usage="%(prog)s [options]")
+    parser.add_argument("--scales", help="comma separated record numbers"
+        " [default: %(default)s]", default="1000,10000,100000",
+        metavar="STR")
+    parser.add_argument("--repeat", help="timed runs of each benchmark"
+        " [default: %(default)s]", type=int, default=3, metavar="INT")
+    parser.add_argument("--seed", help="generator seed"
+        " [default: %(default)s]", type=int, default=1, metavar="INT")
+    parser.add_argument("--only", help="comma separated substrings of"
+        " benchmark names to run [default: all]", metavar="STR")
+    parser.add_argument("--workdir", help="directory of generated data"
+        " [default: system temp]", metavar="DIR")
+    parser.add_argument("-o", "--output", help="json result file"
+        " [default: stdout]", metavar="FILE")
+    parser.add_argument("--compare", help="json result of a previous run to"
+        " compare with", metavar="FILE")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    scales = [int(i) for i in args.scales.split(",")]
+    only = None
+    if args.only:
+        only = args.only.split(",")
+    result = run_benchmarks(scales, args.repeat, args.seed, only,
+        args.workdir)
+    if args.output:
+        with open(args.output, "w") as out_fp:
+            json.dump(result, out_fp, indent=2)
+    else:
+        json.dump(result, sys.stdout, indent=2)
+        print()
+    if args.compare:
+        with open(args.compare) as io:
+            compare(json.load(io), result, sys.stderr)
+
+if __name__ == "__main__":
+    main()
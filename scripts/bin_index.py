@@ -1,4 +1,6 @@
 import sys
+import bisect
+from array import array
 
 class interval(object):
     def __init__(self, start, end, *data):
@@ -31,6 +33,17 @@ class interval(object):
     def __str__(self):
         return "{}\t{}".format(self.start, self.end)
 
+
+class interval_view(interval):
+    """
+    interval of an array backed index, created on demand from coordinates
+    that are valid already
+    """
+    def __init__(self, start, end, data=None):
+        self.start = start
+        self.end = end
+        self.data = data
+
 class BinIndex(object):
     def __init__(self):
         self.db = dict()
@@ -43,6 +56,8 @@ class BinIndex(object):
         for i in range(self.num_bin_levels-2, -1, -1):
             self._binOffsetsExtended[i] = self._binOffsetsExtended[i+1] + (
                 1 << ((self.num_bin_levels-2-i) * 3))
+        # start sorted arrays for batch query, built on demand
+        self._sorted = None
     
     def _getBin(self, start, end):
         end -= 1
@@ -55,7 +70,25 @@ class BinIndex(object):
             end >>= self._binNextShift
         return -1
     
+    def _getLevel(self, bin_num):
+        for i in range(self.num_bin_levels):
+            if bin_num >= self._binOffsetsExtended[i]:
+                return i
+        return -1
+
+    def bin_key(self, _interval):
+        """
+        (level, bin) of _interval, get_overlap reports intervals in this
+        order, then in insertion order. level is -1 for an illegal bin.
+        """
+        bin_num = self._getBin(_interval.start, _interval.end)
+        return self._getLevel(bin_num), bin_num
+
+    def level_shift(self, level):
+        return self._binFirstShift + level * self._binNextShift
+
     def add_interval(self, _interval):
+        self._sorted = None
         bin_num = self._getBin(_interval.start, _interval.end)
         if (bin_num < 0 or bin_num > self.num_bins):
             print("[BinIndex] Error: Received illegal bin "
@@ -68,6 +101,14 @@ class BinIndex(object):
     def build_db(self, _intervals):
         for i in _intervals:
             self.add_interval(i)
+
+    def records(self):
+        """
+        (start, end, data) of every interval, in no particular order
+        """
+        for intervals in self.db.values():
+            for i in intervals:
+                yield i.start, i.end, i.data
     
     def get_overlap(self, _interval):
         result = []
@@ -88,6 +129,273 @@ class BinIndex(object):
             return result
         return 0
 
+    def to_sorted(self):
+        """
+        flatten bins into a SortedBinIndex, interval codes are positions in
+        its intervals list
+        """
+        if self._sorted is not None:
+            return self._sorted
+        records = []
+        for bin_num, intervals in self.db.items():
+            level = self._getLevel(bin_num)
+            if level < 0:
+                continue # illegal bin, never reported by get_overlap
+            for n, i in enumerate(intervals):
+                records.append((level, bin_num, n, i))
+        records.sort(key=lambda x: x[:3])
+        groups = self._sorted_groups((record[0], record[3].start,
+            record[3].end, rank) for rank, record in enumerate(records))
+        self._sorted = SortedBinIndex(groups, intervals=[i[3] for i in
+            records])
+        return self._sorted
+
+    def _sorted_groups(self, records):
+        """
+        SortedBinIndex levels of (level, start, end, code) in get_overlap
+        traversal order, the rank of a record is its position
+        """
+        levels = [[] for i in range(self.num_bin_levels)]
+        for rank, (level, start, end, code) in enumerate(records):
+            levels[level].append((start, rank, end, code))
+        groups = []
+        for level in range(self.num_bin_levels):
+            if len(levels[level]) == 0:
+                continue
+            levels[level].sort(key=lambda x: x[:2])
+            starts = array("l")
+            ends = array("l")
+            ranks = array("l")
+            codes = array("l")
+            max_span = 0
+            for start, rank, end, code in levels[level]:
+                starts.append(start)
+                ends.append(end)
+                ranks.append(rank)
+                codes.append(code)
+                if end - start > max_span:
+                    max_span = end - start
+            shift = self.level_shift(level)
+            groups.append((shift, max_span, starts, ends, ranks, codes))
+        return groups
+
+    def get_overlap_batch(self, starts, ends):
+        """
+        batch version of get_overlap, see SortedBinIndex.get_overlap_batch
+        """
+        return self.to_sorted().get_overlap_batch(starts, ends)
+
+
+class CompactBinIndex(BinIndex):
+    """
+    BinIndex keeping the intervals of a bin as arrays of start, end and data
+    code instead of interval objects. A data code is the position of the
+    data in self.data, equal data share a code, so a few families take a
+    byte per interval. get_overlap creates the intervals it reports.
+    """
+    def __init__(self):
+        BinIndex.__init__(self)
+        self.data = []
+        self._data_codes = dict()
+        # widened to "l" when a code does not fit
+        self._code_type = "B"
+
+    def _code(self, data):
+        # bed_reader data is a list of fields, the type keeps 1 and 1.0 or
+        # a list and a tuple apart
+        if isinstance(data, list):
+            key = (list, tuple(data))
+        else:
+            key = (type(data), data)
+        try:
+            code = self._data_codes.get(key)
+        except TypeError:
+            # unhashable data is not shared
+            self.data.append(data)
+            return len(self.data) - 1
+        if code is None:
+            code = len(self.data)
+            self._data_codes[key] = code
+            self.data.append(data)
+        return code
+
+    def _widen_codes(self):
+        self._code_type = "l"
+        for columns in self.db.values():
+            columns[2] = array("l", columns[2])
+
+    def add(self, start, end, data=None):
+        """
+        add_interval without creating an interval
+        """
+        if start > end:
+            raise RuntimeError("[interval] Error: interval start larger than"
+                " end, [{},{}]".format(start, end))
+        self._sorted = None
+        bin_num = self._getBin(start, end)
+        if (bin_num < 0 or bin_num > self.num_bins):
+            print("[BinIndex] Error: Received illegal bin "
+                "number {} from _getBin call.".format(bin_num))
+        columns = self.db.get(bin_num)
+        if columns is None:
+            columns = [array("l"), array("l"), array(self._code_type)]
+            self.db[bin_num] = columns
+        columns[0].append(start)
+        columns[1].append(end)
+        code = self._code(data)
+        try:
+            columns[2].append(code)
+        except OverflowError:
+            self._widen_codes()
+            columns[2].append(code)
+
+    def add_interval(self, _interval):
+        self.add(_interval.start, _interval.end, _interval.data)
+
+    def records(self):
+        for starts, ends, codes in self.db.values():
+            for k in range(len(starts)):
+                yield starts[k], ends[k], self.data[codes[k]]
+
+    def get_overlap(self, _interval):
+        result = []
+        q_start = _interval.start
+        q_end = _interval.end
+        start_bin = q_start >> self._binFirstShift
+        end_bin = q_end >> self._binFirstShift
+        for i in range(self.num_bin_levels):
+            offset = self._binOffsetsExtended[i]
+            for j in range(start_bin+offset, end_bin+offset+1):
+                if j not in self.db:
+                    continue
+                starts, ends, codes = self.db[j]
+                for k in range(len(starts)):
+                    if starts[k] > q_end or ends[k] < q_start:
+                        continue
+                    result.append(interval_view(starts[k], ends[k],
+                        self.data[codes[k]]))
+            start_bin >>= self._binNextShift
+            end_bin >>= self._binNextShift
+        if (len(result)>0):
+            return result
+        return 0
+
+    def to_sorted(self):
+        """
+        flatten bins into a SortedBinIndex, interval codes are data codes
+        """
+        if self._sorted is not None:
+            return self._sorted
+        records = []
+        for bin_num, (starts, ends, codes) in self.db.items():
+            level = self._getLevel(bin_num)
+            if level < 0:
+                continue # illegal bin, never reported by get_overlap
+            for n in range(len(starts)):
+                records.append((level, bin_num, n, starts[n], ends[n],
+                    codes[n]))
+        records.sort(key=lambda x: x[:3])
+        groups = self._sorted_groups((record[0], record[3], record[4],
+            record[5]) for record in records)
+        self._sorted = SortedBinIndex(groups, data=self.data)
+        return self._sorted
+
+
+class SortedBinIndex(object):
+    """
+    Read only form of BinIndex, intervals of each bin level are kept in start
+    sorted arrays. levels is a list of (shift, max_span, starts, ends, ranks,
+    codes), shift is the bin shift of the level, ranks are positions in
+    BinIndex.get_overlap traversal order. A code is a position in intervals,
+    or in data if intervals are not given, then intervals are created on
+    demand with data[code] as their data. The arrays can be any sequence of
+    int, e.g. memoryview of a memory mapped file.
+    """
+    def __init__(self, levels, intervals=None, data=None):
+        self.levels = levels
+        self.intervals = intervals
+        self.data = data
+
+    def __len__(self):
+        return sum([len(i[2]) for i in self.levels])
+
+    def _interval(self, start, end, code):
+        if self.intervals is not None:
+            return self.intervals[code]
+        return interval_view(start, end, self.data[code])
+
+    def code_data(self, code):
+        """
+        interval data of a code
+        """
+        if self.intervals is not None:
+            return self.intervals[code].data
+        return self.data[code]
+
+    def records(self):
+        """
+        (start, end, data) of every interval, in no particular order
+        """
+        for shift, max_span, starts, ends, ranks, codes in self.levels:
+            for k in range(len(starts)):
+                yield starts[k], ends[k], self.code_data(codes[k])
+
+    def get_overlap(self, _interval):
+        result = [i[1] for i in self.get_overlap_batch([_interval.start],
+            [_interval.end])]
+        if (len(result)>0):
+            return result
+        return 0
+
+    def get_overlap_batch(self, starts, ends):
+        """
+        batch version of BinIndex.get_overlap, starts and ends are query
+        coordinates sorted by start. Return a list of (query index, interval,
+        overlap length), grouped by query index, intervals of a query are in
+        the same order as BinIndex.get_overlap returns them.
+        """
+        if len(starts) != len(ends):
+            raise RuntimeError("[BinIndex] Error: starts and ends of batch "
+                "query differ in length.")
+        for i in range(1, len(starts)):
+            if starts[i] < starts[i-1]:
+                raise RuntimeError("[BinIndex] Error: batch query is not "
+                    "sorted by start, {} after {}".format(starts[i],
+                    starts[i-1]))
+        hits = [[] for i in range(len(starts))]
+        for shift, max_span, s_starts, s_ends, s_ranks, s_codes in (
+            self.levels):
+            lo = 0
+            for qi in range(len(starts)):
+                q_start = starts[qi]
+                q_end = ends[qi]
+                q_bin = q_start >> shift
+                q_hits = hits[qi]
+                # nothing starting before q_start - max_span reaches q_start
+                lo = bisect.bisect_left(s_starts, q_start - max_span, lo)
+                hi = bisect.bisect_right(s_starts, q_end, lo)
+                for k in range(lo, hi):
+                    s_end = s_ends[k]
+                    if s_end < q_start:
+                        continue
+                    s_start = s_starts[k]
+                    if s_start < q_start:
+                        # get_overlap only scans bins from q_start onward
+                        if (s_start >> shift) < q_bin:
+                            continue
+                    q_hits.append((s_ranks[k], s_start, s_end, s_codes[k]))
+        result = []
+        for qi in range(len(starts)):
+            q_hits = hits[qi]
+            if len(q_hits) > 1:
+                q_hits.sort()
+            q_start = starts[qi]
+            q_end = ends[qi]
+            for rank, s_start, s_end, code in q_hits:
+                result.append((qi, self._interval(s_start, s_end, code),
+                    min(q_end, s_end) - max(q_start, s_start) + 1))
+        return result
+
 class bed_reader(object):
     def __init__(self, bed_fn):
         self.bed = bed_fn
@@ -112,12 +420,17 @@ class bed_reader(object):
                     _interval = interval(start, end)
                 yield chrom, _interval
 
-def build_db_from_bed(bed):
+def build_db_from_bed(bed, compact=False):
+    """
+    dict of chrom: BinIndex of a bed file, CompactBinIndex if compact is
+    true
+    """
+    index_class = CompactBinIndex if compact else BinIndex
     bed_db = dict()
     bed_iter = bed_reader(bed)
     for chrom, _interval in bed_iter:
             if  chrom not in bed_db:
-                bed_db[chrom] = BinIndex()
+                bed_db[chrom] = index_class()
                 bed_db[chrom].add_interval(_interval)
             else:
                 bed_db[chrom].add_interval(_interval)
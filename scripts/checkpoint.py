@@ -0,0 +1,111 @@
+"""
+Checkpoints of intermediate files of a run.
+
+A checkpoint, <intermediate>.ckpt, records the fingerprints of the inputs of
+the stage that wrote the intermediate and the size and mtime of the
+intermediate itself. A resumed run skips a stage when its checkpoint matches
+the current inputs and the intermediate is unchanged. The checkpoint is
+removed before a stage runs and written only after it succeeds, so a
+partial intermediate is never reused.
+
+Large inputs (vcf, bam and its index, databases) are fingerprinted by size
+and mtime, small intermediates by sha1.
+"""
+import os
+import json
+
+from rmsk_cache import file_sha1
+
+STAGES = ("del_annot", "ins_seq", "blast")
+BAM_INDEX_SUFFIXES = (".bai", ".csi", ".crai")
+
+
+def file_stat(path):
+    """
+    absolute path, size and mtime of path, None if it does not exist
+    """
+    if path is None or not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return {"path": os.path.abspath(path), "size": stat.st_size,
+        "mtime": stat.st_mtime_ns}
+
+
+def bam_fingerprint(bam):
+    index = None
+    base = os.path.splitext(bam)[0]
+    for suffix in BAM_INDEX_SUFFIXES:
+        for path in [bam + suffix, base + suffix]:
+            if index is None and os.path.exists(path):
+                index = path
+    return {"bam": file_stat(bam), "index": file_stat(index)}
+
+
+def blast_db_fingerprint(blast_db):
+    return dict((suffix, file_stat(blast_db + suffix)) for suffix in
+        ["", ".nhr", ".nin", ".nsq"])
+
+
+class policy(object):
+    """
+    resume is true to skip stages with a valid checkpoint, force is the
+    stages to run anyway
+    """
+    def __init__(self, resume=False, force=()):
+        self.resume = resume
+        self.force = set(force)
+        for stage in self.force:
+            if stage not in STAGES:
+                raise RuntimeError("[checkpoint] Error: Unknown stage {}, "
+                    "expect one of {}".format(stage, ", ".join(STAGES)))
+
+    def checkpoint(self, stage, output, inputs):
+        return checkpoint(stage, output, inputs, self.resume and
+            stage not in self.force)
+
+
+class checkpoint(object):
+    def __init__(self, stage, output, inputs, resume=True):
+        self.stage = stage
+        self.output = output
+        self.path = output + ".ckpt"
+        self.inputs = inputs
+        self.resume = resume
+
+    def valid(self):
+        """
+        true if the stage can be skipped
+        """
+        if not self.resume or not os.path.exists(self.path):
+            return 0
+        try:
+            with open(self.path, "r") as io:
+                record = json.load(io)
+        except ValueError:
+            return 0
+        output = file_stat(self.output)
+        if output is None:
+            return 0
+        # as read back from json, tuples are lists
+        inputs = json.loads(json.dumps(self.inputs))
+        return (record.get("stage") == self.stage and
+            record.get("inputs") == inputs and
+            record.get("output") == output)
+
+    def start(self):
+        """
+        call before the stage writes its output
+        """
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def commit(self):
+        """
+        call after the stage succeeded
+        """
+        tmp = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp, "w") as out_fp:
+            json.dump({"stage": self.stage, "inputs": self.inputs,
+                "output": file_stat(self.output)}, out_fp, indent=2,
+                sort_keys=True)
+        os.replace(tmp, self.path)
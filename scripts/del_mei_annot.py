@@ -3,9 +3,24 @@ Mobile Element Insertion Annotation for DELs.
 50% overlap reciprocally
 """
 import sys
+import bisect
+import logging
+import multiprocessing
+from array import array
 
 import sv_vcf
 import bin_index
+import rmsk_cache
+import metrics
+import vcf_reader
+import table_writer
+
+# mei_type of rmsk records, position is the family code in rmsk cache
+MEI_FAMILIES = ["Alu", "L1", "SVA", "Other"]
+# families rmsk_db.search can report, others are not loaded by default
+SEARCH_FAMILIES = ("Alu", "L1", "SVA")
+# both breakpoints of a DEL must be within the window of a family record
+BREAKPOINT_WINDOWS = {"Alu": 20, "L1": 200, "SVA": 200}
 
 def format_rmsk(rmsk_file, rmsk_out):
     out = open(rmsk_out, "w")
@@ -42,79 +57,489 @@ class rmsk(object):
         else:
             return "Other"
 
+class breakpoint_index(object):
+    """
+    records of each family of BREAKPOINT_WINDOWS sorted by start, with ends
+    alongside. A DEL is looked up by bisecting the records starting within
+    the window of its start, so repeat dense regions cost no more than the
+    records near the breakpoint.
+    """
+    def __init__(self, records):
+        """
+        records are (start, end, family)
+        """
+        by_family = dict()
+        for start, end, family in records:
+            if family in BREAKPOINT_WINDOWS:
+                by_family.setdefault(family, []).append((start, end))
+        self.families = []
+        for family in sorted(by_family):
+            pairs = sorted(by_family[family])
+            self.families.append((family, BREAKPOINT_WINDOWS[family],
+                array("l", [i[0] for i in pairs]),
+                array("l", [i[1] for i in pairs])))
+
+    def search(self, start, end):
+        """
+        family of the matching record with the closest breakpoints, 0 if
+        none. A record matches if both breakpoints are within the window of
+        its family and the overlap is 50% reciprocal. Ties are broken by
+        start, end and family.
+        """
+        best = None
+        size = end - start + 1
+        for family, window, starts, ends in self.families:
+            lo = bisect.bisect_left(starts, start - window)
+            hi = bisect.bisect_right(starts, start + window, lo)
+            for k in range(lo, hi):
+                s_end = ends[k]
+                if abs(s_end - end) > window:
+                    continue
+                s_start = starts[k]
+                overlap = min(s_end, end) - max(s_start, start) + 1
+                if (overlap/size < 0.5 or
+                    overlap/(s_end - s_start + 1) < 0.5):
+                    continue
+                key = (abs(s_start - start) + abs(s_end - end), s_start,
+                    s_end, family)
+                if best is None or key < best:
+                    best = key
+        if best is None:
+            return 0
+        return best[3]
+
+
 class rmsk_db(object):
-    def __init__(self):
+    """
+    rmsk CompactBinIndex of each chromosome, only records of families are
+    kept, all records are kept if families is None. A chromosome is loaded
+    when it is first searched.
+    """
+    def __init__(self, families=SEARCH_FAMILIES):
         self.db = dict()
+        if families is None:
+            self.families = None
+        else:
+            self.families = sorted(set(families))
+        self._cache = None
+        self._rmsk_formated = None
+        self._blocks = dict()
+        self._unsorted = set()
+        self._breakpoints = dict()
+
+    def loadDB(self, rmsk_formated, cache=True):
+        """
+        open formated rmsk. If cache is true the binary cache next to it is
+        used; it holds the records of self.families only, and its header
+        keep field makes a cache of other families stale. A missing or stale
+        cache is rebuilt by loading every chromosome here. Chromosomes are
+        only loaded lazily from a fresh cache, or without cache, where the
+        text file is only scanned for chromosome positions here.
+        """
+        self.db = dict()
+        self._cache = None
+        self._rmsk_formated = rmsk_formated
+        self._blocks = dict()
+        self._unsorted = set()
+        self._breakpoints = dict()
+        with metrics.stage("rmsk_load"):
+            if cache:
+                self._cache = rmsk_cache.open_cache(rmsk_formated,
+                    self.families)
+                if self._cache is not None:
+                    metrics.count("rmsk_cache_hits")
+                    return
+                self._parse(rmsk_formated)
+                try:
+                    rmsk_cache.write_cache(rmsk_formated,
+                        rmsk_cache.cache_path(rmsk_formated), self.db,
+                        MEI_FAMILIES, self.families)
+                except OSError as e:
+                    logging.warning("[rmsk_db] Can not write rmsk cache for "
+                        "{}: {}".format(rmsk_formated, e))
+            else:
+                self._scan(rmsk_formated)
+
+    @property
+    def chroms(self):
+        if self._cache is not None:
+            return self._cache.chroms
+        return sorted(set(self.db) | set(self._blocks))
+
+    def get_index(self, chrom):
+        """
+        BinIndex of chrom, loaded on first call, None if chrom has no record
+        """
+        if chrom in self.db:
+            return self.db[chrom]
+        if self._cache is not None:
+            index = self._cache.get(chrom)
+            if index is not None:
+                self.db[chrom] = index
+            return index
+        if chrom in self._blocks:
+            # every record of the chromosome may be filtered out
+            with metrics.stage("rmsk_load"):
+                self._load_blocks(self._blocks[chrom])
+            return self.db.get(chrom)
+        return None
+
+    def get_breakpoints(self, chrom):
+        """
+        breakpoint_index of chrom, built from its index on first call, None
+        if chrom has no record
+        """
+        if chrom not in self._breakpoints:
+            index = self.get_index(chrom)
+            if index is not None:
+                index = breakpoint_index(index.records())
+            self._breakpoints[chrom] = index
+        return self._breakpoints[chrom]
 
-    def loadDB(self, rmsk_formated):
+    def _add(self, line):
+        rmsk_record = rmsk(line)
+        mei_type = rmsk_record.mei_type
+        if self.families is not None and mei_type not in self.families:
+            return
+        if rmsk_record.chr not in self.db:
+            self.db[rmsk_record.chr] = bin_index.CompactBinIndex()
+        self.db[rmsk_record.chr].add(rmsk_record.start, rmsk_record.end,
+            mei_type)
+
+    def _parse(self, rmsk_formated):
         with open(rmsk_formated, "r") as io:
             io.readline() # remove header
             for line in io:
-                rmsk_record = rmsk(line)
-                _interval = bin_index.interval(rmsk_record.start,
-                    rmsk_record.end, rmsk_record.mei_type)
-                if rmsk_record.chr not in self.db:
-                    self.db[rmsk_record.chr] = bin_index.BinIndex()
-                    self.db[rmsk_record.chr].add_interval(_interval)
-                else:
-                    self.db[rmsk_record.chr].add_interval(_interval)
+                self._add(line)
+
+    def _scan(self, rmsk_formated):
+        """
+        record (offset, length) of each run of lines of a chromosome, and
+        chromosomes whose records are not sorted by start
+        """
+        start_pre = dict()
+        with open(rmsk_formated, "rb") as io:
+            io.readline() # remove header
+            offset = io.tell()
+            chrom_pre = None
+            for line in io:
+                fields = line.split(b"\t", 8)
+                chrom = fields[6].decode()
+                start = int(fields[7])
+                if chrom != chrom_pre:
+                    if chrom not in self._blocks:
+                        self._blocks[chrom] = []
+                        start_pre[chrom] = start
+                    self._blocks[chrom].append([offset, 0])
+                    chrom_pre = chrom
+                if start < start_pre[chrom]:
+                    self._unsorted.add(chrom)
+                start_pre[chrom] = start
+                self._blocks[chrom][-1][1] += len(line)
+                offset += len(line)
+
+    def _load_blocks(self, blocks):
+        with open(self._rmsk_formated, "rb") as io:
+            for offset, length in blocks:
+                io.seek(offset)
+                for line in io.read(length).decode().splitlines():
+                    self._add(line)
+
+    def is_sorted(self, chrom):
+        """
+        records of chrom are sorted by start, needs loadDB without cache
+        """
+        return chrom not in self._unsorted
+
+    def stream(self, chrom):
+        """
+        yield interval and BinIndex.bin_key of records of chrom in file order
+        without indexing them, needs loadDB without cache
+        """
+        if chrom not in self._blocks:
+            return
+        _bin_index = bin_index.BinIndex()
+        with open(self._rmsk_formated, "rb") as io:
+            for offset, length in self._blocks[chrom]:
+                io.seek(offset)
+                io_block = io.read(length).decode()
+                for line in io_block.splitlines():
+                    rmsk_record = rmsk(line)
+                    mei_type = rmsk_record.mei_type
+                    if (self.families is not None and
+                        mei_type not in self.families):
+                        continue
+                    _interval = bin_index.interval(rmsk_record.start,
+                        rmsk_record.end, mei_type)
+                    yield _interval, _bin_index.bin_key(_interval)
+
+    def _match(self, query_interval, _interval, overlap):
+        if (overlap/query_interval.size >= 0.5 and
+            overlap/_interval.size >= 0.5):
+            if _interval.data == "Alu":
+                if (abs(query_interval.start - _interval.start) <= 20
+                    and abs(query_interval.end - _interval.end) <= 20):
+                    return 1
+            elif _interval.data == "L1" or _interval.data == "SVA":
+                if (abs(query_interval.start - _interval.start) <= 200
+                    and abs(query_interval.end - _interval.end) <= 200):
+                    return 1
+        return 0
 
     def search(self, chrom, query_interval):
-        if chrom not in self.db:
+        index = self.get_index(chrom)
+        if index is None:
             return 0
-        overlaps = self.db[chrom].get_overlap(query_interval)
+        overlaps = index.get_overlap(query_interval)
+        metrics.count("del_queries")
         if overlaps:
+            metrics.count("rmsk_candidates", len(overlaps))
             for _interval in overlaps:
                 overlap = min(_interval.end, query_interval.end) - max(
                     _interval.start, query_interval.start) + 1
-                if overlap/query_interval.size >= 0.5 and
-                    overlap/_interval.size >= 0.5:
-                    if _interval.data == "Alu":
-                        if (abs(query_interval.start - _interval.start) <= 20
-                            and abs(query_interval.end - _interval.end) <= 20):
-                            return _interval.data # first match
-                    elif _interval.data == "L1" or _interval.data == "SVA":
-                        if (abs(query_interval.start - _interval.start) <= 200
-                            and abs(query_interval.end - _interval.end) <= 200):
-                            return _interval.data # first match
+                if self._match(query_interval, _interval, overlap):
+                    return _interval.data # first match
             return 0 # no match
         else:
             return 0
 
+    def search_batch(self, chrom, query_intervals):
+        """
+        search all DELs of a chromosome in one pass, results are in the same
+        order as query_intervals and equal to calling search one by one
+        """
+        results = [0] * len(query_intervals)
+        metrics.count("del_queries", len(query_intervals))
+        index = self.get_index(chrom)
+        if index is None:
+            return results
+        order = sorted(range(len(query_intervals)),
+            key=lambda x: query_intervals[x].start)
+        starts = [query_intervals[i].start for i in order]
+        ends = [query_intervals[i].end for i in order]
+        candidates = index.get_overlap_batch(starts, ends)
+        metrics.count("rmsk_candidates", len(candidates))
+        for qi, _interval, overlap in candidates:
+            query_interval = query_intervals[order[qi]]
+            if results[order[qi]]:
+                continue # first match
+            if self._match(query_interval, _interval, overlap):
+                results[order[qi]] = _interval.data
+        return results
+
+    def search_breakpoints(self, chrom, query_intervals):
+        """
+        search all DELs of a chromosome in the breakpoint_index, results are
+        in the same order as query_intervals. They differ from search_batch
+        only for a DEL matching several records: search reports the first
+        in bin order, this the one with the closest breakpoints.
+        """
+        results = [0] * len(query_intervals)
+        metrics.count("del_queries", len(query_intervals))
+        index = self.get_breakpoints(chrom)
+        if index is None:
+            return results
+        for i, query_interval in enumerate(query_intervals):
+            results[i] = index.search(query_interval.start,
+                query_interval.end)
+        return results
+
+def sweep_search(dels, _rmsk_db):
+    """
+    Merge join DELs with rmsk records of _rmsk_db, both sorted by start in
+    each chromosome, yield chrom, query interval and the result of
+    rmsk_db.search. Only records that may overlap the current DEL are kept in
+    memory. _rmsk_db must be loaded without cache. DELs of a chromosome with
+    unsorted records, and all DELs after an unsorted DEL, are searched in the
+    index of _rmsk_db.
+    """
+    _bin_index = bin_index.BinIndex()
+    dels = iter(dels)
+    chroms_seen = set()
+    chrom_pre = None
+    start_pre = None
+    records = None
+    pending = None
+    active = []
+    for chrom, query_interval in dels:
+        if chrom != chrom_pre:
+            if chrom in chroms_seen:
+                break
+            chroms_seen.add(chrom)
+            chrom_pre = chrom
+            start_pre = None
+            if _rmsk_db.is_sorted(chrom):
+                records = _rmsk_db.stream(chrom)
+                pending = next(records, None)
+            else:
+                records = None
+            active = []
+        if start_pre is not None and query_interval.start < start_pre:
+            break
+        start_pre = query_interval.start
+        if records is None:
+            yield chrom, query_interval, _rmsk_db.search(chrom,
+                query_interval)
+            continue
+
+        while pending is not None and pending[0].start <= query_interval.end:
+            active.append(pending)
+            pending = next(records, None)
+        # queries are sorted by start, records ended here are done
+        active = [i for i in active if i[0].end >= query_interval.start]
+        candidates = []
+        for _interval, key in active:
+            if _interval.start > query_interval.end:
+                continue
+            level = key[0]
+            if level < 0:
+                continue # never reported by BinIndex.get_overlap
+            shift = _bin_index.level_shift(level)
+            if (_interval.start < query_interval.start and
+                (_interval.start >> shift) < (query_interval.start >> shift)):
+                continue # get_overlap only scans bins from query start
+            candidates.append((key, _interval))
+        # get_overlap order, stable sort keeps file order in a bin
+        candidates.sort(key=lambda x: x[0])
+        metrics.count("del_queries")
+        metrics.count("rmsk_candidates", len(candidates))
+        result = 0
+        for key, _interval in candidates:
+            overlap = min(_interval.end, query_interval.end) - max(
+                _interval.start, query_interval.start) + 1
+            if _rmsk_db._match(query_interval, _interval, overlap):
+                result = _interval.data # first match
+                break
+        yield chrom, query_interval, result
+    else:
+        return
+
+    logging.warning("[sweep_search] DELs are not sorted from {}:{}, fall "
+        "back to indexed search".format(chrom, query_interval.start))
+    yield chrom, query_interval, _rmsk_db.search(chrom, query_interval)
+    for chrom, query_interval in dels:
+        yield chrom, query_interval, _rmsk_db.search(chrom, query_interval)
+
+
+# rmsk_db of a search_parallel worker process
+_worker_db = None
+
+def _init_worker(rmsk_formated, families, cache):
+    global _worker_db
+    _worker_db = rmsk_db(families)
+    _worker_db.loadDB(rmsk_formated, cache)
+
+def _search_chrom(task):
+    chrom, starts, ends, breakpoints = task
+    query_intervals = [bin_index.interval(i, j) for i, j in zip(starts, ends)]
+    if breakpoints:
+        return chrom, _worker_db.search_breakpoints(chrom, query_intervals)
+    return chrom, _worker_db.search_batch(chrom, query_intervals)
+
+def worker_pool(rmsk_formated, jobs, families=SEARCH_FAMILIES, cache=True):
+    """
+    a pool of jobs worker processes each holding rmsk_formated, the rmsk
+    cache is built first here if it is used so that they all map the same
+    file
+    """
+    if cache:
+        rmsk_db(families).loadDB(rmsk_formated)
+    return multiprocessing.Pool(jobs, _init_worker, (rmsk_formated, families,
+        cache))
+
+def search_parallel(rmsk_formated, queries, jobs, families=SEARCH_FAMILIES,
+    cache=True, pool=None, breakpoints=False, cancel=None):
+    """
+    search_batch the query intervals of each chromosome in queries, a dict of
+    chrom: [interval], with jobs worker processes, one chromosome per task,
+    or search_breakpoints if breakpoints is true. A worker_pool of the same
+    rmsk_formated can be given to be reused across calls. Return a dict of
+    chrom: results, same as search_batch. Raise once cancel, a
+    threading.Event, is set.
+    """
+    # large chromosomes first to balance workers
+    chroms = sorted(queries, key=lambda x: (-len(queries[x]), x))
+    tasks = [(chrom, [i.start for i in queries[chrom]],
+        [i.end for i in queries[chrom]], breakpoints) for chrom in chroms]
+    results = dict()
+    if pool is not None:
+        _collect_results(pool.imap_unordered(_search_chrom, tasks), results,
+            cancel)
+        return results
+    with worker_pool(rmsk_formated, jobs, families, cache) as pool:
+        _collect_results(pool.imap_unordered(_search_chrom, tasks), results,
+            cancel)
+    return results
+
+
+def _collect_results(chrom_results, results, cancel=None):
+    for chrom, result in chrom_results:
+        if cancel is not None and cancel.is_set():
+            raise RuntimeError("[search_parallel] Error: cancelled")
+        results[chrom] = result
+
+
 class del_reader(object):
-    def __init__(self, vcf):
+    """
+    DELs of a vcf file, plain or gzip and optionally restricted to regions
+    as in vcf_reader, or of a vcf_table.vcf_table
+    """
+    def __init__(self, vcf, regions=None):
         self.vcf = vcf
-    
+        self.regions = regions
+
+    def _records(self):
+        if not isinstance(self.vcf, str):
+            for sv in self.vcf:
+                yield sv
+            return
+        for line in vcf_reader.vcf_reader(self.vcf, self.regions):
+            if line[0] == "#" or not sv_vcf.prefilter(line, ("DEL",)):
+                continue
+            yield sv_vcf.lazy_sv_vcf_record(line)
+
     def __iter__(self):
-        with open(self.vcf,"r") as io:
-            for line in io:
-                if line[0] == "#":
-                    continue
-                sv = sv_vcf.sv_vcf_record(line)
-                if (sv.svtype == "DEL" and sv.svlen != "NA" and
-                    abs(sv.svlen) > 100 and abs(sv.svlen) < 11000):
-                    if "chr" not in sv.chrom1:
-                        sv.chrom1 = "chr" + sv.chrom1
-                    if int(sv.pos1) > int(sv.pos2):
-                        raise RuntimeError("pos1 > pos2 for DEL {}".format(
-                            sv.id))
-                    yield sv.chrom1, bin_index.interval(int(sv.pos1),
-                        int(sv.pos2), sv.id)       
+        for sv in self._records():
+            if (sv.svtype == "DEL" and sv.svlen != "NA" and
+                abs(sv.svlen) > 100 and abs(sv.svlen) < 11000):
+                chrom = sv.chrom1
+                if "chr" not in chrom:
+                    chrom = "chr" + chrom
+                if int(sv.pos1) > int(sv.pos2):
+                    raise RuntimeError("pos1 > pos2 for DEL {}".format(
+                        sv.id))
+                yield chrom, bin_index.interval(int(sv.pos1),
+                    int(sv.pos2), sv.id)
 
 def main():
     if len(sys.argv) < 4:
-        print("Usage: python3 {} <vcf> <rmsk> <outfile>")
+        print("Usage: python3 {} <vcf> <rmsk> <outfile> [jobs]".format(
+            sys.argv[0]))
         sys.exit(1)
-    
-    _rmsk_db = rmsk_db()
-    _rmsk_db.loadDB(sys.argv[2])
+    jobs = 1
+    if len(sys.argv) > 4:
+        jobs = int(sys.argv[4])
 
-    out = open(sys.argv[3],"w")
+    queries = dict()
     for chrom, q_interval in del_reader(sys.argv[1]):
-        result = _rmsk_db.search(chrom, q_interval)
-        if result:
-            print("{}\t{}".format(q_interval.data, result), file=out)
-    out.close()
+        if chrom not in queries:
+            queries[chrom] = [q_interval]
+        else:
+            queries[chrom].append(q_interval)
+
+    if jobs > 1:
+        results = search_parallel(sys.argv[2], queries, jobs)
+    else:
+        _rmsk_db = rmsk_db()
+        _rmsk_db.loadDB(sys.argv[2])
+        results = dict((chrom, _rmsk_db.search_batch(chrom, queries[chrom]))
+            for chrom in queries)
+
+    # outfile ending with .gz is bgzip compressed
+    with table_writer.table_writer(sys.argv[3]) as out:
+        for chrom in queries:
+            out.write_rows((q_interval.data, result) for q_interval, result
+                in zip(queries[chrom], results[chrom]) if result)
 
 if __name__ == "__main__":
     main()
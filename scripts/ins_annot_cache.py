@@ -0,0 +1,96 @@
+"""
+Cross-run cache of insert sequence annotations.
+
+The best blast hit of an insert sequence, as ins_seq_annot.best_hit_iter
+gives it without the query id, is stored in a sqlite database keyed by the
+sha1 of the sequence and the fingerprint of the blast database. Sequences
+without any hit are stored too. The least recently used entries are evicted
+when the cache holds more than max_entries.
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import hashlib
+
+import rmsk_cache
+
+
+def db_fingerprint(blast_db):
+    """
+    sha1 of the blast database fasta and its blast index files
+    """
+    sha1 = hashlib.sha1()
+    for suffix in ["", ".nhr", ".nin", ".nsq"]:
+        path = blast_db + suffix
+        if not os.path.exists(path):
+            continue
+        sha1.update(suffix.encode())
+        rmsk_cache.file_sha1(path, sha1)
+    return sha1.hexdigest()
+
+
+def seq_key(seq):
+    return hashlib.sha1(seq.upper().encode()).hexdigest()
+
+
+class annot_cache(object):
+    """
+    get and put best hit fields of a sequence, cost is the blast seconds
+    spent on it, summed over cache hits as saved time
+    """
+    def __init__(self, path, db_fp, max_entries=1000000):
+        self.path = path
+        self.db_fp = db_fp
+        self.max_entries = max_entries
+        self.lookups = 0
+        self.hits = 0
+        self.saved_seconds = 0.0
+        self.blast_seconds = 0.0
+        self._conn = sqlite3.connect(path, timeout=60)
+        self._conn.execute("CREATE TABLE IF NOT EXISTS annot (db TEXT, "
+            "seq TEXT, fields TEXT, cost REAL, last_used REAL, "
+            "PRIMARY KEY (db, seq))")
+        self._used = []
+
+    def get(self, seq):
+        """
+        return (found, fields), fields is None for a sequence without hit
+        """
+        self.lookups += 1
+        key = seq_key(seq)
+        row = self._conn.execute("SELECT fields, cost FROM annot WHERE "
+            "db = ? AND seq = ?", (self.db_fp, key)).fetchone()
+        if row is None:
+            return 0, None
+        self.hits += 1
+        self.saved_seconds += row[1]
+        self._used.append(key)
+        return 1, json.loads(row[0])
+
+    def put(self, seq, fields, cost):
+        self._conn.execute("INSERT OR REPLACE INTO annot VALUES "
+            "(?, ?, ?, ?, ?)", (self.db_fp, seq_key(seq), json.dumps(fields),
+            cost, time.time()))
+
+    def close(self):
+        now = time.time()
+        self._conn.executemany("UPDATE annot SET last_used = ? WHERE "
+            "db = ? AND seq = ?", [(now, self.db_fp, i) for i in self._used])
+        n = self._conn.execute("SELECT count(*) FROM annot").fetchone()[0]
+        if n > self.max_entries:
+            self._conn.execute("DELETE FROM annot WHERE rowid IN (SELECT "
+                "rowid FROM annot ORDER BY last_used LIMIT ?)",
+                (n - self.max_entries,))
+        self._conn.commit()
+        self._conn.close()
+
+    def report(self, out_fp=sys.stderr):
+        rate = 0.0
+        if self.lookups:
+            rate = 100.0*self.hits/self.lookups
+        print("[ins_annot_cache] {} of {} insert sequences found in cache "
+            "({:.1f}%), blast {:.1f} s, saved about {:.1f} s of blast".format(
+            self.hits, self.lookups, rate, self.blast_seconds,
+            self.saved_seconds), file=out_fp)
@@ -4,10 +4,18 @@ author: Archieyoung <yangqi2@grandomics.com>
 import sys
 import subprocess
 import os
+import time
+import shutil
+import tempfile
+import threading
 import argparse
+from array import array
 
 
 import sv_vcf
+import metrics
+import vcf_reader
+import table_writer
 
 
 class hsp(object):
@@ -41,6 +49,20 @@ def overlap(a_start, a_end, b_start, b_end):
         return min(a_end, b_end) - max(a_start, b_start) + 1            
 
 
+def _walk_cov(starts, ends, lo, hi):
+    """
+    covered length of hsps lo..hi-1 given as sorted starts and ends, each
+    hsp is merged with the previous one only
+    """
+    accumulat_len = ends[lo] - starts[lo] + 1
+    for k in range(lo+1, hi):
+        if ends[k] < starts[k-1] or starts[k] > ends[k-1]:
+            accumulat_len += ends[k] - starts[k] + 1
+        elif ends[k] > ends[k-1]:
+            accumulat_len += ends[k] - ends[k-1]
+    return accumulat_len
+
+
 class hit(object):
     def __init__(self, hsps):
         self.hsps = sorted(hsps, key = lambda x: x.qstart)
@@ -48,77 +70,238 @@ class hit(object):
         self.saccver = hsps[0].saccver
         self.qlen = hsps[0].qend
         self.slen = hsps[0].slen
+        # computed once, by score_hits or on first access
+        self._query_cov = None
+        self._subject_cov = None
+        self._mean_pident = None
     
     @property
     def mean_pident(self):
-        return sum([i.pident for i in self.hsps])/len(self.hsps)
+        if self._mean_pident is None:
+            self._mean_pident = sum([i.pident for i in self.hsps])/len(
+                self.hsps)
+        return self._mean_pident
 
     @property
     def query_cov(self):
-        if len(self.hsps) == 1:
-            return (self.hsps[0].qend - self.hsps[0].qstart +
-                1)/self.hsps[0].qlen
-        
-        accumulat_len = 0
-        pre = None
-        for i in self.hsps:
-            if pre == None:
-                accumulat_len = i.qend - i.qstart + 1
-            else:
-                _overlap = overlap(i.qstart, i.qend, pre.qstart, pre.qend)
-                if _overlap:
-                    if i.qend > pre.qend:
-                        accumulat_len += i.qend - pre.qend
-                else:
-                    accumulat_len += i.qend - i.qstart + 1
-            pre = i
-        return accumulat_len/self.hsps[0].qlen
+        if self._query_cov is None:
+            score_hits([self])
+        return self._query_cov
     
     @property
     def subject_cov(self):
-        if len(self.hsps) == 1:
-            return (self.hsps[0].send - self.hsps[0].sstart +
-                1)/self.hsps[0].slen
-        
-        hsps_tmp = sorted(self.hsps, key = lambda x: x.sstart)
+        if self._subject_cov is None:
+            score_hits([self])
+        return self._subject_cov
 
-        accumulat_len = 0
-        pre = None
-        for i in hsps_tmp:
-            if pre == None:
-                accumulat_len = i.send - i.sstart + 1
-            else:
-                _overlap = overlap(i.sstart, i.send, pre.sstart, pre.send)
-                if _overlap:
-                    if i.send > pre.send:
-                        accumulat_len+= i.send - pre.send
-                else:
-                    accumulat_len += i.send - i.sstart + 1
-            pre = i
-        return accumulat_len/self.hsps[0].slen
+
+def score_hits(hits):
+    """
+    compute query_cov and subject_cov of hits, e.g. all hits of a query, in
+    one pass over column arrays of their hsps
+    """
+    qstarts = []
+    qends = []
+    sstarts = []
+    sends = []
+    bounds = [0]
+    for _hit in hits:
+        for i in _hit.hsps:
+            qstarts.append(i.qstart)
+            qends.append(i.qend)
+        for i in sorted(_hit.hsps, key = lambda x: x.sstart):
+            sstarts.append(i.sstart)
+            sends.append(i.send)
+        bounds.append(len(qstarts))
+    for n, _hit in enumerate(hits):
+        lo = bounds[n]
+        hi = bounds[n+1]
+        _hit._query_cov = _walk_cov(qstarts, qends, lo, hi)/_hit.hsps[0].qlen
+        _hit._subject_cov = _walk_cov(sstarts, sends, lo,
+            hi)/_hit.hsps[0].slen
 
 
 class report_reader(object):
+    """
+    group tabular blast report by query, file is a report file name or an
+    iterable of report lines such as blast_stream
+    """
     def __init__(self, file):
         self.file = file
+
+    def _lines(self):
+        if not isinstance(self.file, str):
+            for line in self.file:
+                yield line
+            return
+        with open(self.file, "r") as io:
+            for line in io:
+                yield line
     
     def __iter__(self):
         qaccver_pre = None
         records = []
-        with open(self.file, "r") as io:
-            for line in io:
-                fields = line.strip().split("\t")
-                _hsp = hsp(fields)
-                if fields[0] != qaccver_pre:
-                    if qaccver_pre != None:
-                        yield records
-                    records = [_hsp]
-                else:
-                    records.append(_hsp)
-                qaccver_pre = fields[0]
+        for line in self._lines():
+            fields = line.strip().split("\t")
+            _hsp = hsp(fields)
+            if fields[0] != qaccver_pre:
+                if qaccver_pre != None:
+                    yield records
+                records = [_hsp]
+            else:
+                records.append(_hsp)
+            qaccver_pre = fields[0]
+        if records:
             yield records
 
 
+class report_block(object):
+    """
+    column arrays of whole query groups of a tabular blast report, groups
+    are (lo, hi) index ranges of each query. sstart <= send as in hsp.
+    """
+    def __init__(self, lines):
+        n = len(lines)
+        text = "".join(lines)
+        if text and not text.endswith("\n"):
+            text += "\n"
+        fields = text.replace("\n", "\t").split("\t")
+        if len(fields) == n * BLAST_NCOLS + 1:
+            # one split of the whole chunk, columns are strided slices
+            cols = [fields[i::BLAST_NCOLS] for i in range(BLAST_NCOLS)]
+            cols[0] = cols[0][:n]
+        elif n:
+            cols = list(zip(*[line.strip().split("\t") for line in lines]))
+        else:
+            cols = [()] * BLAST_NCOLS
+        self.qaccver = cols[0]
+        self.saccver = cols[1]
+        self.qlen = array("l", map(int, cols[2]))
+        self.slen = array("l", map(int, cols[3]))
+        self.qstart = array("l", map(int, cols[4]))
+        self.qend = array("l", map(int, cols[5]))
+        sstart = array("l", map(int, cols[6]))
+        send = array("l", map(int, cols[7]))
+        self.sstart = array("l", map(min, sstart, send))
+        self.send = array("l", map(max, sstart, send))
+        self.pident = array("d", map(float, cols[9]))
+        self.groups = []
+        lo = 0
+        pre = None
+        for i, qaccver in enumerate(self.qaccver):
+            if qaccver != pre:
+                if i > 0:
+                    self.groups.append((lo, i))
+                lo = i
+                pre = qaccver
+        if n:
+            self.groups.append((lo, n))
+
+
+class report_column_reader(object):
+    """
+    read a tabular blast report, yield report_block and (lo, hi) of each
+    query group. A report file name is read in chunks of about chunk_size
+    bytes. An iterable of lines, such as blast_stream, is read one query
+    group at a time, which is yielded as soon as the next query starts.
+    """
+    def __init__(self, file, chunk_size=1 << 22):
+        self.file = file
+        self.chunk_size = chunk_size
+
+    def _chunks(self):
+        with open(self.file, "r") as io:
+            while True:
+                chunk = io.readlines(self.chunk_size)
+                if not chunk:
+                    return
+                yield chunk
+
+    def _stream_groups(self):
+        group = []
+        pre = None
+        for line in self.file:
+            qaccver = line.split("\t", 1)[0]
+            if qaccver != pre and group:
+                yield group
+                group = []
+            group.append(line)
+            pre = qaccver
+        if group:
+            yield group
+
+    def __iter__(self):
+        if not isinstance(self.file, str):
+            for group in self._stream_groups():
+                metrics.count("blast_hsps", len(group))
+                block = report_block(group)
+                for lo, hi in block.groups:
+                    yield block, lo, hi
+            return
+        pending = []
+        for chunk in self._chunks():
+            metrics.count("blast_hsps", len(chunk))
+            # the last query group may go on in the next chunk, its lines
+            # are carried forward unparsed and parsed once it is complete
+            qaccver = chunk[-1].split("\t", 1)[0]
+            cut = len(chunk)
+            while cut > 0 and chunk[cut-1].split("\t", 1)[0] == qaccver:
+                cut -= 1
+            if cut == 0:
+                pending.extend(chunk)
+                continue
+            block = report_block(pending + chunk[:cut])
+            pending = chunk[cut:]
+            for lo, hi in block.groups:
+                yield block, lo, hi
+        if pending:
+            block = report_block(pending)
+            for lo, hi in block.groups:
+                yield block, lo, hi
+
+
+def best_hit_fields(block, lo, hi):
+    """
+    best hit of the query group lo..hi-1 of a report_block, same as
+    get_best_hit(hit_iter(hsps)), as [qaccver, saccver, qlen, slen,
+    query_cov, subject_cov, mean_pident]
+    """
+    qstart = block.qstart
+    qend = block.qend
+    sstart = block.sstart
+    send = block.send
+    _max = 0
+    best = None
+    a = lo
+    while a < hi:
+        # hsps of a hit are consecutive lines of one subject
+        b = a + 1
+        while b < hi and block.saccver[b] == block.saccver[a]:
+            b += 1
+        if b - a == 1:
+            order = [a]
+            query_cov = (qend[a] - qstart[a] + 1)/block.qlen[a]
+            subject_cov = (send[a] - sstart[a] + 1)/block.slen[a]
+        else:
+            order = sorted(range(a, b), key = qstart.__getitem__)
+            s_order = sorted(order, key = sstart.__getitem__)
+            query_cov = _walk_cov([qstart[i] for i in order],
+                [qend[i] for i in order], 0, b - a)/block.qlen[order[0]]
+            subject_cov = _walk_cov([sstart[i] for i in s_order],
+                [send[i] for i in s_order], 0, b - a)/block.slen[order[0]]
+        cov_product = query_cov * subject_cov
+        if cov_product > _max:
+            _max = cov_product
+            best = (a, order, query_cov, subject_cov)
+        a = b
+    if best is None:
+        return None
+    a, order, query_cov, subject_cov = best
+    mean_pident = sum([block.pident[i] for i in order])/len(order)
+    return [block.qaccver[a], block.saccver[a], block.qend[a], block.slen[a],
+        query_cov, subject_cov, mean_pident]
+
+
 class hit_iter(object):
     def __init__(self, records):
         self.records = records
@@ -145,7 +328,9 @@ def get_best_hit(_hit_iter):
     """
     _max = 0
     _best_hit = None
-    for hit in _hit_iter:
+    hits = list(_hit_iter)
+    score_hits(hits)
+    for hit in hits:
         cov_product = hit.query_cov * hit.subject_cov
         if cov_product > _max:
             _max = cov_product
@@ -153,35 +338,177 @@ def get_best_hit(_hit_iter):
     return _best_hit
 
 
-def run_get_ins_seq_bam(prog, vcf, bam, output):
-    out_fp = open(output, "w")
-    subprocess.run([prog, vcf, bam], stdout=out_fp)
-    out_fp.close()
-
-def run_get_ins_seq_vcf(vcf, output):
-    out_fp = open(output, "w")
+def split_vcf(vcf, nshards, prefix):
+    """
+    split the records of a plain vcf into at most nshards vcfs of
+    contiguous records, i.e. genomic chunks of a sorted vcf, with about the
+    same number of records and the full header each. Return the shard file
+    names in record order.
+    """
+    total = 0
+    with open(vcf, "r") as io:
+        for line in io:
+            if line[0] != "#":
+                total += 1
+    nshards = max(1, min(nshards, total))
+    shards = ["{}.shard{}.vcf".format(prefix, i) for i in range(nshards)]
+    header = []
+    out_fp = None
+    n = 0
     with open(vcf, "r") as io:
         for line in io:
-            line = line.strip()
             if line[0] == "#":
+                header.append(line)
+                continue
+            shard = n*nshards//total
+            if out_fp is None or out_fp.name != shards[shard]:
+                if out_fp is not None:
+                    out_fp.close()
+                out_fp = open(shards[shard], "w")
+                out_fp.write("".join(header))
+            out_fp.write(line)
+            n += 1
+    if out_fp is None:
+        out_fp = open(shards[0], "w")
+        out_fp.write("".join(header))
+    out_fp.close()
+    return shards
+
+
+def ins_seq_command(prog, vcf, bam, max_reads=0):
+    """
+    sv_ins_seq command line, max_reads > 0 caps the insert sequences of an
+    INS that go into its consensus
+    """
+    if max_reads < 0:
+        raise RuntimeError("[ins_seq_command] Error: max_reads must not be "
+            "negative, got {}".format(max_reads))
+    if max_reads > 0:
+        return [prog, vcf, bam, str(max_reads)]
+    return [prog, vcf, bam]
+
+
+def wait_runners(runners, cancel=None):
+    """
+    poll subprocess runners until all exit, return the index and return code
+    of the first one failing, None if all succeeded. Raise when cancel, a
+    threading.Event, is set meanwhile, the caller stops the others.
+    """
+    pending = list(range(len(runners)))
+    while pending:
+        if cancel is not None and cancel.is_set():
+            raise RuntimeError("[wait_runners] Error: cancelled")
+        for i in list(pending):
+            returncode = runners[i].poll()
+            if returncode is None:
                 continue
-            sv_record = sv_vcf.sv_vcf_record(line)
-            if sv_record.svtype == "INS":
-                ins_id = sv_record.id
-                for i in sv_record.alt:
-                    if i not in ["A","T","C","G","N"]:
-                        raise RuntimeError("[run_get_ins_seq] Error: "
-                            "Invalic Insert sequence {}".format(sv_record.alt))
-                    else:
-                        ins_seq = sv_record.alt
-                print(">{}\n{}".format(ins_id, ins_seq), file=out_fp)
+            pending.remove(i)
+            if returncode != 0:
+                return i, returncode
+        if pending:
+            time.sleep(0.1)
+    return None
+
+
+def run_get_ins_seq_bam(prog, vcf, bam, output, nshards=1, max_reads=0,
+    cancel=None):
+    """
+    insert sequences of INS records of vcf to fasta output. With nshards > 1
+    the records are split by split_vcf and the shards are extracted by
+    concurrent prog processes on the same bam, then merged in vcf order.
+    stderr of shard i is kept in output.shard<i>.log and copied to stderr
+    in shard order. max_reads > 0 keeps at most max_reads sequences per INS
+    for consensus, reads in RNAMES first, then those with length closest to
+    SVLEN. prog is stopped when cancel, a threading.Event, is set.
+    """
+    if nshards > 1:
+        with metrics.stage("sv_ins_seq"):
+            _run_get_ins_seq_shards(prog, vcf, bam, output, nshards,
+                max_reads, cancel)
+        return
+    out_fp = open(output, "w")
+    runner = None
+    try:
+        with metrics.stage("sv_ins_seq"):
+            runner = subprocess.Popen(ins_seq_command(prog, vcf, bam,
+                max_reads), stdout=out_fp)
+            failed = wait_runners([runner], cancel)
+    finally:
+        if runner is not None and runner.poll() is None:
+            runner.terminate()
+            runner.wait()
+        out_fp.close()
+    if failed is not None:
+        raise RuntimeError("[run_get_ins_seq_bam] Error: {} return code was "
+            "{} for {}".format(prog, failed[1], bam))
+
+
+def _run_get_ins_seq_shards(prog, vcf, bam, output, nshards, max_reads=0,
+    cancel=None):
+    shards = split_vcf(vcf, nshards, output)
+    fastas = ["{}.shard{}.fasta".format(output, i) for i in range(len(
+        shards))]
+    logs = ["{}.shard{}.log".format(output, i) for i in range(len(shards))]
+    runners = []
+    files = []
+    try:
+        for shard, fasta, log in zip(shards, fastas, logs):
+            files.append(open(fasta, "w"))
+            files.append(open(log, "w"))
+            runners.append(subprocess.Popen(ins_seq_command(prog, shard,
+                bam, max_reads), stdout=files[-2], stderr=files[-1]))
+        # a failed shard stops the others at once
+        failed = wait_runners(runners, cancel)
+        if failed is not None:
+            raise RuntimeError("[run_get_ins_seq_bam] Error: {} return code "
+                "was {} for {} shard {}, see {}".format(prog, failed[1], bam,
+                failed[0], logs[failed[0]]))
+    finally:
+        for runner in runners:
+            if runner.poll() is None:
+                runner.terminate()
+                runner.wait()
+        for out_fp in files:
+            out_fp.close()
+        for log in logs:
+            if os.path.exists(log):
+                with open(log, "r") as io:
+                    shutil.copyfileobj(io, sys.stderr)
+
+    with open(output, "w") as out_fp:
+        for fasta in fastas:
+            with open(fasta, "r") as io:
+                shutil.copyfileobj(io, out_fp)
+    for path in shards + fastas:
+        os.remove(path)
+
+def run_get_ins_seq_vcf(vcf, output, regions=None):
+    out_fp = open(output, "w")
+    for line in vcf_reader.vcf_reader(vcf, regions):
+        line = line.strip()
+        if line[0] == "#" or not sv_vcf.prefilter(line, ("INS",)):
+            continue
+        sv_record = sv_vcf.lazy_sv_vcf_record(line)
+        if sv_record.svtype == "INS":
+            ins_id = sv_record.id
+            for i in sv_record.alt:
+                if i not in ["A","T","C","G","N"]:
+                    raise RuntimeError("[run_get_ins_seq] Error: "
+                        "Invalic Insert sequence {}".format(sv_record.alt))
+                else:
+                    ins_seq = sv_record.alt
+            print(">{}\n{}".format(ins_id, ins_seq), file=out_fp)
     out_fp.close()
 
 
+BLAST_OUTFMT = ("6 qaccver saccver qlen slen qstart qend sstart send sstrand "
+    "pident length mismatch gapopen evalue bitscore")
+BLAST_NCOLS = len(BLAST_OUTFMT.split()) - 1
+
+
 def run_blast(prog, query, db, nthread, output):
     out_fp = open(output, "w")
-    outfmt = ("6 qaccver saccver qlen slen qstart qend sstart send sstrand "
-        "pident length mismatch gapopen evalue bitscore")
+    outfmt = BLAST_OUTFMT
     runner = subprocess.Popen([prog, "-query", query, "-db", db, "-outfmt",
         outfmt, "-num_threads", nthread], stdout=out_fp)
     runner.wait()
@@ -191,37 +518,210 @@ def run_blast(prog, query, db, nthread, output):
     out_fp.close()
 
 
-def run_ins_annot(blast_report, outfile):
-    reader = report_reader(blast_report)
-    with open(outfile, "w") as io:
-        print("#id\ttarget\ttarget_type\tquery_length\ttarget_lenght\t"
-            "query_cov\ttarget_cov\tmean_identity", file=io)
-        for report in reader:
-            _best_hit = get_best_hit(hit_iter(report))
-            if "." in _best_hit.saccver:
-                target_type = _best_hit.saccver.split(".")[0]
+def fasta_reader(fasta):
+    name = None
+    seq = []
+    with open(fasta, "r") as io:
+        for line in io:
+            line = line.strip()
+            if not line:
+                continue
+            if line[0] == ">":
+                if name is not None:
+                    yield name, "".join(seq)
+                name = line[1:]
+                seq = []
             else:
-                target_type = _best_hit.saccver
-            fields = [_best_hit.qaccver, _best_hit.saccver, target_type,
-                _best_hit.qlen, _best_hit.slen, _best_hit.query_cov,
-                _best_hit.subject_cov, _best_hit.mean_pident]
-            line = "\t".join([str(i) for i in fields])
-            print(line, file = io)
+                seq.append(line)
+    if name is not None:
+        yield name, "".join(seq)
 
-def ins_annot_iter(blast_report):
-    reader = report_reader(blast_report)
-    for report in reader:
-        _best_hit = get_best_hit(hit_iter(report))
-        if "." in _best_hit.saccver:
-            target_type = _best_hit.saccver.split(".")[0]
+
+def split_fasta(fasta, nshards, prefix):
+    """
+    split fasta into at most nshards files of contiguous records with about
+    the same number of bases, return the shard file names in record order
+    """
+    records = list(fasta_reader(fasta))
+    total = sum([len(i[1]) for i in records])
+    nshards = max(1, min(nshards, len(records)))
+    shards = []
+    out_fp = None
+    bases = 0
+    for name, seq in records:
+        # cut when this shard reaches its share of total bases
+        if out_fp is None or (bases >= total*len(shards)/nshards and
+            len(shards) < nshards):
+            if out_fp is not None:
+                out_fp.close()
+            shards.append("{}.shard{}.fasta".format(prefix, len(shards)))
+            out_fp = open(shards[-1], "w")
+        print(">{}\n{}".format(name, seq), file=out_fp)
+        bases += len(seq)
+    if out_fp is not None:
+        out_fp.close()
+    return shards
+
+
+def _spool(pipe, spool):
+    shutil.copyfileobj(pipe, spool)
+    pipe.close()
+
+
+def _kill_on_cancel(runners, cancel, done):
+    """
+    kill runners once cancel is set, until done is set
+    """
+    while not done.wait(0.1):
+        if cancel.is_set():
+            for runner in runners:
+                if runner.poll() is None:
+                    runner.kill()
+            return
+
+
+def blast_stream(prog, query, db, nthread, nshards=1, report=None,
+    cancel=None):
+    """
+    yield tabular report lines from blastn stdout as they are written. query
+    is split into nshards by bases, shards run concurrently and share nthread
+    threads, lines of later shards are spooled until earlier shards are
+    read, so lines are in query order. Lines are also written to report if
+    it is given. blastn is killed when cancel, a threading.Event, is set.
+    """
+    nthread = int(nthread)
+    if cancel is not None and cancel.is_set():
+        raise RuntimeError("[blast_stream] Error: cancelled")
+    if os.path.getsize(query) == 0:
+        # blastn fails on an empty query, e.g. all sequences cached
+        if report is not None:
+            open(report, "w").close()
+        return
+    if nshards > 1:
+        prefix = report
+        if prefix is None:
+            prefix = query
+        shards = split_fasta(query, nshards, prefix)
+    else:
+        shards = [query]
+    shard_threads = str(max(1, nthread//max(1, len(shards))))
+    runners = []
+    spools = []
+    report_fp = None
+    done = threading.Event()
+    watcher = None
+    try:
+        for shard in shards:
+            runners.append(subprocess.Popen([prog, "-query", shard, "-db",
+                db, "-outfmt", BLAST_OUTFMT, "-num_threads", shard_threads],
+                stdout=subprocess.PIPE, universal_newlines=True))
+        if cancel is not None:
+            watcher = threading.Thread(target=_kill_on_cancel, args=(runners,
+                cancel, done))
+            watcher.start()
+        for runner in runners[1:]:
+            # drain later shards so that they do not block on a full pipe
+            spool = tempfile.SpooledTemporaryFile(max_size=64 << 20,
+                mode="w+")
+            thread = threading.Thread(target=_spool, args=(runner.stdout,
+                spool))
+            thread.start()
+            spools.append((spool, thread))
+        if report is not None:
+            report_fp = open(report, "w")
+        for n, runner in enumerate(runners):
+            if n == 0:
+                lines = runner.stdout
+            else:
+                spool, thread = spools[n-1]
+                thread.join()
+                spool.seek(0)
+                lines = spool
+            for line in lines:
+                if report_fp is not None:
+                    report_fp.write(line)
+                yield line
+            runner.wait()
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("[blast_stream] Error: cancelled")
+            if runner.returncode != 0:
+                raise RuntimeError("[blast_stream] Error: blast return code "
+                    "was not equal 0 for {}".format(shards[n]))
+    finally:
+        done.set()
+        if watcher is not None:
+            watcher.join()
+        for runner in runners:
+            if runner.poll() is None:
+                runner.kill()
+            runner.wait()
+            runner.stdout.close()
+        for spool, thread in spools:
+            thread.join()
+            spool.close()
+        if report_fp is not None:
+            report_fp.close()
+        if nshards > 1:
+            for shard in shards:
+                os.remove(shard)
+
+
+def run_blast_sharded(prog, query, db, nthread, output, nshards):
+    """
+    run_blast with query split into nshards by bases, see blast_stream
+    """
+    if nshards <= 1:
+        run_blast(prog, query, db, str(nthread), output)
+        return
+    for line in blast_stream(prog, query, db, nthread, nshards, output):
+        pass
+
+
+def _annot_rows(blast_report):
+    for block, lo, hi in report_column_reader(blast_report):
+        fields = best_hit_fields(block, lo, hi)
+        if "." in fields[1]:
+            target_type = fields[1].split(".")[0]
         else:
-            target_type = _best_hit.saccver
+            target_type = fields[1]
+        yield fields[:2] + [target_type] + fields[2:]
+
+
+def run_ins_annot(blast_report, outfile):
+    """
+    best hit of every query, outfile ending with .gz is bgzip compressed
+    """
+    with table_writer.table_writer(outfile) as out:
+        out.write("#id\ttarget\ttarget_type\tquery_length\ttarget_lenght\t"
+            "query_cov\ttarget_cov\tmean_identity\n")
+        out.write_rows(_annot_rows(blast_report))
+
+def annot_pass(fields):
+    """
+    best hit fields pass if coverage on both query and target >= 50%
+    """
+    return fields[5] >= 0.5 and fields[6] >= 0.5
+
+
+def best_hit_iter(blast_report):
+    """
+    best hit fields of every query in blast_report
+    """
+    for block, lo, hi in report_column_reader(blast_report):
+        best = best_hit_fields(block, lo, hi)
+        qaccver, saccver = best[:2]
+        if "." in saccver:
+            target_type = saccver.split(".")[0]
+        else:
+            target_type = saccver
         if target_type == "ALU":
             target_type = "Alu"
-        fields = [_best_hit.qaccver, _best_hit.saccver, target_type,
-            _best_hit.qlen, _best_hit.slen, _best_hit.query_cov,
-            _best_hit.subject_cov, _best_hit.mean_pident]
-        if _best_hit.query_cov >= 0.5 and _best_hit.subject_cov >= 0.5:
+        yield [qaccver, saccver, target_type] + best[2:]
+
+
+def ins_annot_iter(blast_report):
+    for fields in best_hit_iter(blast_report):
+        if annot_pass(fields):
             yield fields
 
 
@@ -234,6 +734,19 @@ def get_args():
         " [default: %(default)s]", metavar="FILE")
     parser.add_argument("--prefix", help="Output file prefix"
         " [default: %(default)s]", metavar="STR")
+    parser.add_argument("--threads", help="blastn threads in total"
+        " [default: %(default)s]", type=int, default=1, metavar="INT")
+    parser.add_argument("--blast-shards", help="split insert sequences into"
+        " shards by bases and run one blastn on each, [default: threads]",
+        type=int, metavar="INT")
+    parser.add_argument("--max-consensus-reads", help="use at most INT insert"
+        " sequences per INS for consensus, reads in RNAMES first, then those"
+        " closest to SVLEN, 0 for all [default: %(default)s]", type=int,
+        default=0, metavar="INT")
+    parser.add_argument("--keep-blast-report", help="write the raw blast"
+        " report to prefix.ins.blast.txt", action="store_true")
+    parser.add_argument("--bgzip", help="write prefix.ins.annot.txt.gz,"
+        " bgzip compressed", action="store_true")
 
     if len(sys.argv) <= 1:
         parser.print_help()
@@ -247,15 +760,24 @@ def main():
     c_sv_ins_seq = os.path.join(os.path.dirname(os.path.abspath(__file__)),
         "../build/bin/sv_ins_seq")
     ins_seq_fasta = args.prefix+".ins.fasta"
-    run_get_ins_seq_bam(c_sv_ins_seq, args.vcf, args.bam, ins_seq_fasta)
+    run_get_ins_seq_bam(c_sv_ins_seq, args.vcf, args.bam, ins_seq_fasta,
+        max_reads=args.max_consensus_reads)
     
     blast_db = os.path.join(os.path.dirname(os.path.abspath(__file__)),
         "../database/Homo_sapiens.mei_virus.db.fasta")
-    blast_report = args.prefix+".ins.blast.txt"
-    run_blast("blastn", ins_seq_fasta, blast_db, "1",
-        blast_report)
+    blast_report = None
+    if args.keep_blast_report:
+        blast_report = args.prefix+".ins.blast.txt"
+    nshards = args.blast_shards
+    if nshards is None:
+        nshards = args.threads
+    lines = blast_stream("blastn", ins_seq_fasta, blast_db, args.threads,
+        nshards, blast_report)
     
-    run_ins_annot(blast_report, args.prefix+".ins.annot.txt")
+    annot_txt = args.prefix+".ins.annot.txt"
+    if args.bgzip:
+        annot_txt += ".gz"
+    run_ins_annot(lines, annot_txt)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
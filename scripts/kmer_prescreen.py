@@ -0,0 +1,260 @@
+"""
+Minimizer prescreen of insert sequences against the MEI/virus database.
+
+Minimizers of canonical k-mers of the database fasta are kept in a sorted
+array, cached on disk next to the fasta. A query sharing no minimizer with
+the database is not sent to blast and is reported as NA.
+
+With the default k=21 and w=8 any exact match of k+w-1=28 bases, the word
+size of the default blastn task megablast, shares a minimizer, so megablast
+seeds are never missed. Use --recall to measure the recall against the blast
+only path on real data.
+"""
+import os
+import sys
+import mmap
+import struct
+import bisect
+import argparse
+from array import array
+from collections import deque
+
+import ins_seq_annot
+import metrics
+import rmsk_cache
+
+K = 21
+W = 8
+MAGIC = b"KMERPRESCREEN1\n"
+_ENCODE = {"A": 0, "C": 1, "G": 2, "T": 3, "a": 0, "c": 1, "g": 2, "t": 3}
+
+
+def _hash(x):
+    x = (x * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF
+    return x ^ (x >> 29)
+
+
+def minimizers(seq, k=K, w=W):
+    """
+    set of minimizer hashes of canonical k-mers of seq in windows of w
+    k-mers, k-mers with non ACGT bases are skipped. A stretch of ACGT bases
+    with less than w k-mers gives its minimum.
+    """
+    mask = (1 << (2*k)) - 1
+    rev_shift = 2*(k-1)
+    result = set()
+    fwd = 0
+    rev = 0
+    run = 0 # ACGT bases in current stretch
+    window = deque() # (k-mer index, hash), increasing hash
+    n = 0 # k-mer index in current stretch
+    for base in seq:
+        code = _ENCODE.get(base)
+        if code is None:
+            if 0 < n < w:
+                result.add(window[0][1])
+            fwd = rev = run = n = 0
+            window.clear()
+            continue
+        fwd = ((fwd << 2) | code) & mask
+        rev = (rev >> 2) | ((3 - code) << rev_shift)
+        run += 1
+        if run < k:
+            continue
+        h = _hash(fwd if fwd < rev else rev)
+        while window and window[-1][1] >= h:
+            window.pop()
+        window.append((n, h))
+        if window[0][0] <= n - w:
+            window.popleft()
+        n += 1
+        if n >= w:
+            result.add(window[0][1])
+    if 0 < n < w:
+        result.add(window[0][1])
+    return result
+
+
+class prescreen_index(object):
+    """
+    sorted minimizer hashes of a database, hashes may be memory mapped
+    """
+    def __init__(self, hashes, k=K, w=W):
+        self.hashes = hashes
+        self.k = k
+        self.w = w
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def __contains__(self, h):
+        i = bisect.bisect_left(self.hashes, h)
+        return i < len(self.hashes) and self.hashes[i] == h
+
+    def shared(self, seq):
+        """
+        number of minimizers of seq found in the index
+        """
+        return sum([1 for h in minimizers(seq, self.k, self.w) if h in self])
+
+    def passes(self, seq, min_shared=1):
+        return self.shared(seq) >= min_shared
+
+
+def cache_path(db_fasta, k=K, w=W):
+    return "{}.prescreen.k{}w{}".format(db_fasta, k, w)
+
+
+def build_index(db_fasta, k=K, w=W):
+    hashes = set()
+    for name, seq in ins_seq_annot.fasta_reader(db_fasta):
+        hashes |= minimizers(seq, k, w)
+    return prescreen_index(array("Q", sorted(hashes)), k, w)
+
+
+def write_index(index, db_fasta, cache_file):
+    header = rmsk_cache.encode_header({"source": rmsk_cache.fingerprint(
+        db_fasta), "k": index.k, "w": index.w, "n": len(index)}, MAGIC)
+    tmp = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp, "wb") as io:
+        io.write(MAGIC)
+        io.write(struct.pack("<Q", len(header)))
+        io.write(header)
+        io.write(array("Q", index.hashes).tobytes())
+    os.replace(tmp, cache_file)
+
+
+def read_index(db_fasta, cache_file):
+    """
+    return the cached prescreen_index, None if it is missing, stale or
+    unreadable. A cache whose fasta only has a new mtime gets it recorded,
+    as rmsk_cache.
+    """
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        mtime = os.stat(db_fasta).st_mtime_ns
+        with open(cache_file, "rb") as io:
+            header = rmsk_cache.read_header(io, MAGIC)
+            if header is None or not rmsk_cache.source_fresh(db_fasta,
+                header["source"]):
+                return None
+            data_start = io.tell()
+            data_end = data_start + header["n"]*8
+            if os.fstat(io.fileno()).st_size < data_end:
+                raise ValueError("truncated, expect {} bytes".format(
+                    data_end))
+            _mmap = mmap.mmap(io.fileno(), 0, access=mmap.ACCESS_READ)
+        hashes = memoryview(_mmap)[data_start:data_end].cast("Q")
+        index = prescreen_index(hashes, header["k"], header["w"])
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        print("[kmer_prescreen] Warning: Can not read prescreen cache {}: "
+            "{}".format(cache_file, e), file=sys.stderr)
+        return None
+    if header["source"]["mtime"] != mtime:
+        try:
+            rmsk_cache.update_mtime(cache_file, header, mtime, MAGIC)
+        except OSError as e:
+            print("[kmer_prescreen] Warning: Can not update prescreen cache "
+                "{}: {}".format(cache_file, e), file=sys.stderr)
+    return index
+
+
+def load_index(db_fasta, k=K, w=W):
+    """
+    open the cached index of db_fasta, build and cache it if it is missing
+    or stale
+    """
+    cache_file = cache_path(db_fasta, k, w)
+    with metrics.stage("prescreen_load"):
+        index = read_index(db_fasta, cache_file)
+        if index is None:
+            index = build_index(db_fasta, k, w)
+            try:
+                write_index(index, db_fasta, cache_file)
+            except OSError as e:
+                print("[kmer_prescreen] Warning: Can not write prescreen "
+                    "cache {}: {}".format(cache_file, e), file=sys.stderr)
+    return index
+
+
+def filter_fasta(index, fasta, output, min_shared=1):
+    """
+    write records of fasta passing the prescreen to output, return the
+    number of records and of passed records
+    """
+    total = 0
+    passed = 0
+    with open(output, "w") as out_fp:
+        for name, seq in ins_seq_annot.fasta_reader(fasta):
+            total += 1
+            if index.passes(seq, min_shared):
+                passed += 1
+                print(">{}\n{}".format(name, seq), file=out_fp)
+    return total, passed
+
+
+def recall_report(index, fasta, blast_db, out_fp, prog="blastn", nthread=1,
+    min_shared=1):
+    """
+    blast every record of fasta and report the fraction of annotated records
+    that pass the prescreen, with the ids of missed records
+    """
+    passed = set()
+    total = 0
+    for name, seq in ins_seq_annot.fasta_reader(fasta):
+        total += 1
+        if index.passes(seq, min_shared):
+            passed.add(name.split()[0])
+    annotated = [i[0] for i in ins_seq_annot.ins_annot_iter(
+        ins_seq_annot.blast_stream(prog, fasta, blast_db, nthread))]
+    missed = [i for i in annotated if i not in passed]
+    recall = "NA"
+    if annotated:
+        recall = (len(annotated) - len(missed))/len(annotated)
+    print("#metric\tvalue", file=out_fp)
+    print("queries\t{}".format(total), file=out_fp)
+    print("prescreen_pass\t{}".format(len(passed)), file=out_fp)
+    print("prescreen_skip\t{}".format(total - len(passed)), file=out_fp)
+    print("blast_annotated\t{}".format(len(annotated)), file=out_fp)
+    print("annotated_missed\t{}".format(len(missed)), file=out_fp)
+    print("recall\t{}".format(recall), file=out_fp)
+    for i in missed:
+        print("missed\t{}".format(i), file=out_fp)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description="Minimizer prescreen of"
+        " insert sequences against MEI and virus database",
+        usage="%(prog)s [options]")
+    parser.add_argument("--db", help="MEI and virus database fasta"
+        " [default: %(default)s]", metavar="FILE",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "../database/Homo_sapiens.mei_virus.db.fasta"))
+    parser.add_argument("--fasta", help="insert sequence fasta"
+        " [default: %(default)s]", metavar="FILE")
+    parser.add_argument("--output", help="write records passing the"
+        " prescreen to FILE [default: %(default)s]", metavar="FILE")
+    parser.add_argument("--recall", help="write recall against blast only"
+        " annotation of fasta to FILE [default: %(default)s]",
+        metavar="FILE")
+    parser.add_argument("--threads", help="blastn threads for --recall"
+        " [default: %(default)s]", type=int, default=1, metavar="INT")
+    return parser.parse_args()
+
+
+def main():
+    args = get_args()
+    # builds the cache if it is missing or stale
+    index = load_index(args.db)
+    if args.fasta and args.output:
+        total, passed = filter_fasta(index, args.fasta, args.output)
+        print("[kmer_prescreen] {} of {} sequences passed".format(passed,
+            total), file=sys.stderr)
+    if args.fasta and args.recall:
+        with open(args.recall, "w") as out_fp:
+            recall_report(index, args.fasta, args.db, out_fp,
+                nthread=args.threads)
+
+if __name__ == "__main__":
+    main()
@@ -6,77 +6,408 @@ Archieyoung yangqi2@grandomics.com
 
 import sys
 import os
+import time
 import argparse
+import itertools
+import threading
+import concurrent.futures
 from collections import Counter
 
-import sv_vcf
+import vcf_table
+import vcf_reader
 import del_mei_annot
 import ins_seq_annot
+import kmer_prescreen
+import ins_annot_cache
+import checkpoint
+import table_writer
+import metrics
 
+# INFO tag of the annotated vcf
+ANNOT_INFO = "MEI_VIRUS"
+ANNOT_INFO_HEADER = ('##INFO=<ID={},Number=1,Type=String,Description="MEI '
+    'family or virus of the DEL or INS sequence">\n'.format(ANNOT_INFO))
 
-# del mei annot worker
-def run_del_mei_annot(vcf, rmsk_db_file):
-    _rmsk_db = del_mei_annot.rmsk_db()
-    _rmsk_db.loadDB(rmsk_db_file)
 
+# del mei annot worker
+def run_del_mei_annot(vcf, rmsk_db_file, engine="index", jobs=1, rmsk=None,
+    pool=None, cancel=None):
+    """
+    rmsk is an already loaded del_mei_annot.rmsk_db and pool a
+    del_mei_annot.worker_pool to reuse, a sweep engine rmsk must be loaded
+    without cache. Raise once cancel, a threading.Event, is set.
+    """
     _del_reader = del_mei_annot.del_reader(vcf)
 
+    if engine == "sweep":
+        _rmsk_db = rmsk
+        if _rmsk_db is None:
+            _rmsk_db = del_mei_annot.rmsk_db()
+            _rmsk_db.loadDB(rmsk_db_file, cache=False)
+        for chrom, query_interval, result in del_mei_annot.sweep_search(
+            _del_reader, _rmsk_db):
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("[run_del_mei_annot] Error: cancelled")
+            if result:
+                yield query_interval.data, result
+        return
+
+    queries = dict()
     for chrom, query_interval in _del_reader:
-        results = _rmsk_db.search(chrom, query_interval)
-        if results:
-            yield query_interval.data, results
+        if chrom not in queries:
+            queries[chrom] = [query_interval]
+        else:
+            queries[chrom].append(query_interval)
 
+    breakpoints = engine == "breakpoint"
+    if pool is not None or jobs > 1:
+        results = del_mei_annot.search_parallel(rmsk_db_file, queries, jobs,
+            pool=pool, breakpoints=breakpoints, cancel=cancel)
+    else:
+        _rmsk_db = rmsk
+        if _rmsk_db is None:
+            _rmsk_db = del_mei_annot.rmsk_db()
+            _rmsk_db.loadDB(rmsk_db_file)
+        if breakpoints:
+            search = _rmsk_db.search_breakpoints
+        else:
+            search = _rmsk_db.search_batch
+        results = dict()
+        for chrom in queries:
+            if cancel is not None and cancel.is_set():
+                raise RuntimeError("[run_del_mei_annot] Error: cancelled")
+            results[chrom] = search(chrom, queries[chrom])
+
+    for chrom in queries:
+        for query_interval, result in zip(queries[chrom], results[chrom]):
+            if result:
+                yield query_interval.data, result
+
+
+def collect_del_annot(vcf, rmsk_db_file, engine="index", jobs=1, rmsk=None,
+    pool=None, tmp=None, checkpoints=None, cancel=None):
+    """
+    dict of svid: MEI family of annotated DELs, Other is not reported. With
+    checkpoints, a checkpoint.policy, the dict is kept in tmp.del.txt and
+    reused by a resumed run. cancel is a threading.Event stopping the search.
+    """
+    ckpt = None
+    if checkpoints is not None:
+        ckpt = checkpoints.checkpoint("del_annot", tmp+".del.txt",
+            {"vcf": checkpoint.file_stat(vcf.vcf), "regions": vcf.regions,
+            "rmsk": checkpoint.file_stat(rmsk_db_file), "engine": engine})
+        if ckpt.valid():
+            print("[checkpoint] DEL annotation of {} is up to date".format(
+                ckpt.output), file=sys.stderr)
+            with open(ckpt.output, "r") as io:
+                del_annot_dict = dict(line.rstrip("\n").split("\t") for line
+                    in io)
+            metrics.count("del_annotated", len(del_annot_dict))
+            return del_annot_dict
+        ckpt.start()
+
+    del_annot_dict = dict()
+    with metrics.stage("del_annot"):
+        for svid, annot in run_del_mei_annot(vcf, rmsk_db_file, engine, jobs,
+            rmsk, pool, cancel):
+            if annot != "Other":
+                del_annot_dict[svid] = annot
+    metrics.count("del_annotated", len(del_annot_dict))
+
+    if ckpt is not None:
+        with open(ckpt.output, "w") as out_fp:
+            for svid, annot in del_annot_dict.items():
+                print("{}\t{}".format(svid, annot), file=out_fp)
+        ckpt.commit()
+    return del_annot_dict
+
+
+class cancel_on_error(object):
+    """
+    done callback of futures, sets cancel, a threading.Event, when the first
+    of them fails and keeps that future in failed
+    """
+    def __init__(self, cancel):
+        self.cancel = cancel
+        self.failed = None
+        self._lock = threading.Lock()
+
+    def __call__(self, future):
+        if future.cancelled() or future.exception() is None:
+            return
+        with self._lock:
+            if self.failed is None:
+                self.failed = future
+        self.cancel.set()
+
+
+# sv_ins_seq worker, vcf is a vcf_table, return the insert sequence fasta.
+# sv_ins_seq is stopped when cancel, a threading.Event, is set
+def extract_ins_seq(vcf, bam, tmp, prog, checkpoints=None, shards=1,
+    max_reads=0, cancel=None):
+    # sv_ins_seq only reads the INS records
+    ins_vcf = tmp+".ins.vcf"
+    vcf.write_vcf(ins_vcf, ("INS",))
 
-# ins seq annot worker
-def run_ins_annot(vcf, bam, blast_db, tmp, prog):
-    
     ins_seq_fasta = tmp+".ins.fasta"
-    ins_seq_annot.run_get_ins_seq_bam(prog, vcf, bam, ins_seq_fasta)
+    ckpt = None
+    if checkpoints is not None:
+        ckpt = checkpoints.checkpoint("ins_seq", ins_seq_fasta,
+            {"ins_vcf": checkpoint.file_sha1(ins_vcf),
+            "bam": checkpoint.bam_fingerprint(bam),
+            "prog": checkpoint.file_stat(prog), "max_reads": max_reads})
+        if ckpt.valid():
+            print("[checkpoint] {} is up to date, skip sv_ins_seq".format(
+                ins_seq_fasta), file=sys.stderr)
+            return ins_seq_fasta
+        ckpt.start()
+    ins_seq_annot.run_get_ins_seq_bam(prog, ins_vcf, bam, ins_seq_fasta,
+        shards, max_reads, cancel)
+    if ckpt is not None:
+        ckpt.commit()
+    return ins_seq_fasta
+
+
+# ins seq annot worker, vcf is a vcf_table
+def run_ins_annot(vcf, bam, blast_db, tmp, prog, threads=1, blast_shards=1,
+    keep_blast_report=False, prescreen=False, annot_cache=None,
+    annot_cache_size=1000000, checkpoints=None, ins_seq_shards=1,
+    max_consensus_reads=0, cancel=None):
+    ins_seq_fasta = extract_ins_seq(vcf, bam, tmp, prog, checkpoints,
+        ins_seq_shards, max_consensus_reads, cancel)
+
+    index = None
+    if prescreen:
+        index = kmer_prescreen.load_index(blast_db)
+    cache = None
+    if annot_cache is not None:
+        cache = ins_annot_cache.annot_cache(annot_cache,
+            ins_annot_cache.db_fingerprint(blast_db), annot_cache_size)
+
+    for svid, annot in annot_ins_fasta(ins_seq_fasta, blast_db, tmp,
+        threads, blast_shards, keep_blast_report, index, cache, checkpoints,
+        cancel):
+        yield svid, annot
+
+    if cache is not None:
+        cache.close()
+        cache.report()
+
+
+def annot_ins_fasta(ins_seq_fasta, blast_db, tmp, threads=1, blast_shards=1,
+    keep_blast_report=False, index=None, cache=None, checkpoints=None,
+    cancel=None):
+    """
+    annotate the insert sequences of ins_seq_fasta, index is a loaded
+    kmer_prescreen index and cache an open ins_annot_cache.annot_cache, both
+    optional. With checkpoints the blast report is always kept and a resumed
+    run reads it instead of running blastn. blastn is killed when cancel, a
+    threading.Event, is set.
+    """
+    if metrics.enabled():
+        metrics.count("ins_sequences", sum([1 for i in
+            ins_seq_annot.fasta_reader(ins_seq_fasta)]))
+    if cache is not None:
+        # only sequences not in cache are sent to blast
+        misses = dict()
+        miss_fasta = tmp+".ins.miss.fasta"
+        with metrics.stage("annot_cache"), open(miss_fasta, "w") as out_fp:
+            for name, seq in ins_seq_annot.fasta_reader(ins_seq_fasta):
+                svid = name.split()[0]
+                found, fields = cache.get(seq)
+                if not found:
+                    misses[svid] = seq
+                    print(">{}\n{}".format(name, seq), file=out_fp)
+                elif fields is not None:
+                    fields = [svid] + fields
+                    if ins_seq_annot.annot_pass(fields):
+                        metrics.count("ins_annotated")
+                        yield fields[0], fields[2]
+        metrics.count("annot_cache_hits", cache.hits)
+        ins_seq_fasta = miss_fasta
+
+    if index is not None:
+        # sequences sharing no minimizer with blast_db are reported as NA
+        prescreen_fasta = tmp+".ins.prescreen.fasta"
+        with metrics.stage("prescreen"):
+            total, passed = kmer_prescreen.filter_fasta(index, ins_seq_fasta,
+                prescreen_fasta)
+        metrics.count("prescreen_skipped", total - passed)
+        print("[kmer_prescreen] {} of {} insert sequences sent to "
+            "blast".format(passed, total), file=sys.stderr)
+        if cache is not None:
+            # skipped sequences are not blasted, do not cache them
+            blasted = set(name.split()[0] for name, seq in
+                ins_seq_annot.fasta_reader(prescreen_fasta))
+            misses = dict((i, misses[i]) for i in misses if i in blasted)
+        ins_seq_fasta = prescreen_fasta
     
-    blast_report = tmp+".ins.blast.txt"
-    ins_seq_annot.run_blast("blastn", ins_seq_fasta, blast_db, "1",
-        blast_report)
+    # best hits are selected while blastn is running
+    blast_report = None
+    if keep_blast_report or checkpoints is not None:
+        blast_report = tmp+".ins.blast.txt"
+    if metrics.enabled():
+        metrics.count("blast_queries", sum([1 for i in
+            ins_seq_annot.fasta_reader(ins_seq_fasta)]))
+    ckpt = None
+    if checkpoints is not None:
+        # the queries actually blasted, after cache and prescreen
+        ckpt = checkpoints.checkpoint("blast", blast_report,
+            {"query": checkpoint.file_sha1(ins_seq_fasta),
+            "db": checkpoint.blast_db_fingerprint(blast_db),
+            "outfmt": ins_seq_annot.BLAST_OUTFMT})
+    if ckpt is not None and ckpt.valid():
+        print("[checkpoint] {} is up to date, skip blastn".format(
+            blast_report), file=sys.stderr)
+        lines = blast_report
+        ckpt = None
+    else:
+        if ckpt is not None:
+            ckpt.start()
+        lines = ins_seq_annot.blast_stream("blastn", ins_seq_fasta, blast_db,
+            threads, blast_shards, blast_report, cancel)
     
-    for i in ins_seq_annot.ins_annot_iter(blast_report):
-        yield i[0], i[2]
+    start = time.time()
+    best_hits = dict()
+    # the consumer of the annotations is not timed in the blast stage
+    for fields in metrics.stage_iter("blast",
+        ins_seq_annot.best_hit_iter(lines)):
+        metrics.count("blast_best_hits")
+        if cache is not None:
+            best_hits[fields[0]] = fields
+        if ins_seq_annot.annot_pass(fields):
+            metrics.count("ins_annotated")
+            yield fields[0], fields[2]
+        else:
+            metrics.count("blast_hits_filtered")
+    # the whole report is written once the stream is exhausted
+    if ckpt is not None:
+        ckpt.commit()
 
+    if cache is not None:
+        cache.blast_seconds = time.time() - start
+        bases = sum([len(i) for i in misses.values()])
+        for svid, seq in misses.items():
+            fields = best_hits.get(svid)
+            if fields is not None:
+                fields = fields[1:]
+            cost = 0.0
+            if bases:
+                cost = cache.blast_seconds*len(seq)/bases
+            cache.put(seq, fields, cost)
 
-def vcf2bed_pe(sv_record, annot):
-    return "\t".join(str(i) for i in [sv_record.chrom1, sv_record.pos1,
-        sv_record.chrom2, sv_record.pos2, sv_record.svtype, sv_record.id,
-        sv_record.svlen, annot])
 
+def table_path(outfile, compress=False):
+    if compress:
+        return outfile+".gz"
+    return outfile
 
-def reporter(vcf, del_annot_dict, ins_annot_dict, outfile):
-    del_num_total = 0
-    ins_num_total = 0
-    out_fp = open(outfile, "w")
-    with open(vcf, "r") as io:
-            for line in io:
-                line = line.strip()
-                if line[0] == "#":
-                    continue
-                 
-                sv = sv_vcf.sv_vcf_record(line)
-                if sv.svtype == "DEL":
-                    del_num_total += 1
-                    if sv.id in del_annot_dict:
-                        print(vcf2bed_pe(sv, del_annot_dict[sv.id]),
-                            file = out_fp)
-                    else:
-                        print(vcf2bed_pe(sv, "NA"), file = out_fp)
-                if sv.svtype == "INS":
-                    ins_num_total += 1
-                    if sv.id in ins_annot_dict:
-                        print(vcf2bed_pe(sv, ins_annot_dict[sv.id]),
-                            file = out_fp)
-                    else:
-                        print(vcf2bed_pe(sv, "NA"), file = out_fp)
-    out_fp.close()
 
-    out_fp = open(outfile+".summary", "w")
-    del_counter = Counter(del_annot_dict.values())
-    ins_counter = Counter(ins_annot_dict.values())
+def annotated_vcf_path(outfile, compress=False):
+    return table_path(outfile+".vcf", compress)
+
+
+def reporter(vcf, del_annot_dict, ins_annot_dict, outfile, compress=False,
+    index=False, annotated_vcf=False):
+    """
+    vcf is a vcf_table. With compress the table is bgzip compressed to
+    outfile.gz, with index also tabix indexed. annotated_vcf also writes
+    outfile.vcf[.gz], the input records with the annotation of DELs and INSs
+    in INFO.
+    """
+    with metrics.stage("reporter"):
+        _reporter(vcf, del_annot_dict, ins_annot_dict, outfile, compress,
+            index, annotated_vcf)
+    metrics.count("report_records", len(vcf))
+
+
+def _reporter(vcf, del_annot_dict, ins_annot_dict, outfile, compress=False,
+    index=False, annotated_vcf=False):
+    annots = []
+    for svid, svtype in zip(vcf.ids, vcf.types):
+        if svtype == "DEL":
+            annots.append(del_annot_dict.get(svid, "NA"))
+        elif svtype == "INS":
+            annots.append(ins_annot_dict.get(svid, "NA"))
+        else:
+            annots.append(None)
+
+    # chrom1, pos1, chrom2, pos2, svtype, id, svlen, annot
+    rows = zip(vcf.chroms, vcf.starts, vcf.chroms, vcf.ends, vcf.types,
+        vcf.ids, vcf.svlens, annots)
+    with table_writer.table_writer(table_path(outfile, compress),
+        table_writer.TABIX_BEDPE if index else None) as out:
+        out.write_rows(row for row in rows if row[7] is not None)
+
+    if annotated_vcf:
+        annot_dict = dict((svid, annot) for svid, annot in zip(vcf.ids,
+            annots) if annot is not None and annot != "NA")
+        write_annotated_vcf(vcf, annot_dict, annotated_vcf_path(outfile,
+            compress), index)
+
+    types = Counter(vcf.types)
+    write_summary(outfile+".summary", Counter(del_annot_dict.values()),
+        types["DEL"], Counter(ins_annot_dict.values()), types["INS"])
+
+
+def annotate_record(line, annot_dict, replace=False):
+    """
+    vcf record line with the annotation of its ID added to INFO, replace is
+    true to drop a tag already in INFO
+    """
+    fields = line.rstrip("\n").split("\t", 8)
+    if replace:
+        info = [i for i in fields[7].split(";") if not i.startswith(
+            ANNOT_INFO+"=")]
+        fields[7] = ";".join(info) or "."
+        line = "\t".join(fields) + "\n"
+    annot = annot_dict.get(fields[2])
+    if annot is None:
+        return line
+    tag = "{}={}".format(ANNOT_INFO, annot)
+    if fields[7] == ".":
+        fields[7] = tag
+    else:
+        fields[7] += ";" + tag
+    return "\t".join(fields) + "\n"
+
+
+def split_vcf_header(lines):
+    """
+    header lines and an iterator of the record lines of vcf lines
+    """
+    lines = iter(lines)
+    header = []
+    for line in lines:
+        if line[0] != "#":
+            return header, itertools.chain([line], lines)
+        header.append(line)
+    return header, lines
+
+
+def write_annotated_vcf(vcf, annot_dict, output, index=False):
+    """
+    stream the records of vcf_table vcf, in its regions, to output with
+    annot_dict, svid: annot, as INFO tag
+    """
+    header, records = split_vcf_header(vcf_reader.vcf_reader(vcf.vcf,
+        vcf.regions))
+    # the tags of a vcf annotated before are replaced
+    n = len(header)
+    header = [i for i in header if not i.startswith("##INFO=<ID={},".format(
+        ANNOT_INFO))]
+    replace = len(header) < n
+    header.insert(len(header) - 1, ANNOT_INFO_HEADER)
+    with table_writer.table_writer(output,
+        table_writer.TABIX_VCF if index else None) as out:
+        out.write("".join(header))
+        out.write_lines(annotate_record(line, annot_dict, replace) for line
+            in records)
+
+
+def write_summary(summary, del_counter, del_num_total, ins_counter,
+    ins_num_total):
+    out_fp = open(summary, "w")
     print("#DEL annot summay: \n#sv_type\tannot_type\tnumber", file = out_fp)
     for i in sorted(del_counter):
         print("DEL\t{}\t{}".format(i, del_counter[i]), file = out_fp)
@@ -88,15 +419,316 @@ def reporter(vcf, del_annot_dict, ins_annot_dict, outfile):
     out_fp.close()
 
 
+def read_summary(summary):
+    """
+    counters and totals of a summary written by write_summary
+    """
+    counters = {"DEL": Counter(), "INS": Counter()}
+    totals = {"DEL": 0, "INS": 0}
+    with open(summary, "r") as io:
+        for line in io:
+            if line[0] == "#":
+                continue
+            svtype, annot_type, number = line.rstrip("\n").split("\t")
+            if annot_type == "total":
+                totals[svtype] += int(number)
+            else:
+                counters[svtype][annot_type] += int(number)
+    return counters["DEL"], totals["DEL"], counters["INS"], totals["INS"]
+
+
+def shard_outfile(outfile, index, nshards):
+    return "{}.shard{}of{}".format(outfile, index, nshards)
+
+
+def gather(outfile, nshards, compress=False, index=False,
+    annotated_vcf=False):
+    """
+    concatenate the tables of shards 1..nshards of outfile in shard order,
+    which is genome order, and add up their summaries. Options are those
+    the shards were written with.
+    """
+    shards = [shard_outfile(outfile, i, nshards) for i in range(1,
+        nshards+1)]
+    for shard in shards:
+        paths = [table_path(shard, compress), shard+".summary"]
+        if annotated_vcf:
+            paths.append(annotated_vcf_path(shard, compress))
+        for path in paths:
+            if not os.path.exists(path):
+                raise RuntimeError("[gather] Error: Missing shard output "
+                    "{}".format(path))
+    del_counter = Counter()
+    ins_counter = Counter()
+    del_num_total = 0
+    ins_num_total = 0
+    with table_writer.table_writer(table_path(outfile, compress),
+        table_writer.TABIX_BEDPE if index else None) as out:
+        for shard in shards:
+            out.write_lines(vcf_reader.vcf_reader(table_path(shard,
+                compress)))
+            counts = read_summary(shard+".summary")
+            del_counter += counts[0]
+            del_num_total += counts[1]
+            ins_counter += counts[2]
+            ins_num_total += counts[3]
+    write_summary(outfile+".summary", del_counter, del_num_total,
+        ins_counter, ins_num_total)
+
+    if annotated_vcf:
+        # header of the first shard
+        with table_writer.table_writer(annotated_vcf_path(outfile, compress),
+            table_writer.TABIX_VCF if index else None) as out:
+            for n, shard in enumerate(shards):
+                header, records = split_vcf_header(vcf_reader.vcf_reader(
+                    annotated_vcf_path(shard, compress)))
+                if n == 0:
+                    out.write("".join(header))
+                out.write_lines(records)
+
+
+def read_manifest(manifest):
+    """
+    tab separated lines of sample, vcf and bam, or of vcf and bam with the
+    vcf file name as sample, return a list of (sample, vcf, bam)
+    """
+    samples = []
+    with open(manifest, "r") as io:
+        for line in io:
+            line = line.strip()
+            if not line or line[0] == "#":
+                continue
+            fields = line.split("\t")
+            if len(fields) == 2:
+                sample = os.path.basename(fields[0])
+                for suffix in [".gz", ".vcf"]:
+                    if sample.endswith(suffix):
+                        sample = sample[:-len(suffix)]
+                fields = [sample] + fields
+            if len(fields) != 3:
+                raise RuntimeError("[read_manifest] Error: Invalid manifest "
+                    "line {}".format(line))
+            samples.append(tuple(fields))
+    names = [i[0] for i in samples]
+    for i in names:
+        if names.count(i) > 1:
+            raise RuntimeError("[read_manifest] Error: Duplicate sample "
+                "{}".format(i))
+    return samples
+
+
+def cohort_reporter(samples, tables, del_annot_dicts, ins_annot_dicts,
+    outfile):
+    """
+    sample level counts of every sample plus cohort totals, same annot
+    types as the .summary of each sample
+    """
+    rows = []
+    cohort_counter = Counter()
+    for sample, table, del_annot_dict, ins_annot_dict in zip(samples,
+        tables, del_annot_dicts, ins_annot_dicts):
+        type_counter = Counter(table.types)
+        for svtype, annot_dict in [("DEL", del_annot_dict),
+            ("INS", ins_annot_dict)]:
+            counter = Counter(annot_dict.values())
+            for i in sorted(counter):
+                rows.append((sample, svtype, i, counter[i]))
+                cohort_counter[(svtype, i)] += counter[i]
+            rows.append((sample, svtype, "total", type_counter[svtype]))
+            cohort_counter[(svtype, "total")] += type_counter[svtype]
+
+    out_fp = open(outfile, "w")
+    print("#sample\tsv_type\tannot_type\tnumber", file = out_fp)
+    for row in rows:
+        print("\t".join([str(i) for i in row]), file = out_fp)
+    for svtype in ["DEL", "INS"]:
+        annot_types = sorted(i[1] for i in cohort_counter
+            if i[0] == svtype and i[1] != "total")
+        for i in annot_types + ["total"]:
+            print("cohort\t{}\t{}\t{}".format(svtype, i,
+                cohort_counter[(svtype, i)]), file = out_fp)
+    out_fp.close()
+
+
+def run_cohort(samples, outfile, rmsk_db_file, blast_db, prog, args,
+    regions=None, checkpoints=None):
+    """
+    annotate every (sample, vcf, bam) of samples with rmsk, the blast
+    database, prescreen index and annotation cache loaded once. sv_ins_seq
+    of the samples runs in args.jobs threads while DELs are annotated, then
+    the insert sequences of all samples go through one blastn.
+    """
+    tables = [vcf_table.vcf_table(vcf, regions=regions)
+        for sample, vcf, bam in samples]
+    jobs = max(args.jobs, 1)
+
+    # the first failure of sv_ins_seq or DEL annotation stops the other
+    cancel = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        fastas = [executor.submit(extract_ins_seq, table, bam,
+            "{}.{}.tmp".format(outfile, sample), prog, checkpoints,
+            args.ins_seq_shards, args.max_consensus_reads, cancel)
+            for (sample, vcf, bam), table in zip(samples, tables)]
+        ins_seq_error = cancel_on_error(cancel)
+        for future in fastas:
+            future.add_done_callback(ins_seq_error)
+
+        rmsk = None
+        pool = None
+        del_annot_dicts = []
+        try:
+            if args.del_engine == "sweep":
+                rmsk = del_mei_annot.rmsk_db()
+                rmsk.loadDB(rmsk_db_file, cache=False)
+            elif jobs > 1:
+                pool = del_mei_annot.worker_pool(rmsk_db_file, jobs)
+            else:
+                rmsk = del_mei_annot.rmsk_db()
+                rmsk.loadDB(rmsk_db_file)
+            for (sample, vcf, bam), table in zip(samples, tables):
+                del_annot_dicts.append(collect_del_annot(table, rmsk_db_file,
+                    args.del_engine, jobs, rmsk, pool,
+                    "{}.{}.tmp".format(outfile, sample), checkpoints,
+                    cancel))
+        except Exception:
+            if not cancel.is_set():
+                # the DEL error is raised, stop sv_ins_seq of all samples
+                cancel.set()
+                for future in fastas:
+                    future.cancel()
+                raise
+        finally:
+            if pool is not None:
+                pool.terminate()
+        # the first sv_ins_seq error, not those it cancelled
+        concurrent.futures.wait(fastas)
+        if ins_seq_error.failed is not None:
+            ins_seq_error.failed.result()
+        fastas = [i.result() for i in fastas]
+
+    # query ids are prefixed with the sample index, s<index>_<svid>
+    cohort_tmp = outfile+".tmp.cohort"
+    cohort_fasta = cohort_tmp+".ins.fasta"
+    with open(cohort_fasta, "w") as out_fp:
+        for n, fasta in enumerate(fastas):
+            for name, seq in ins_seq_annot.fasta_reader(fasta):
+                print(">s{}_{}\n{}".format(n, name, seq), file=out_fp)
+
+    index = None
+    if args.prescreen:
+        index = kmer_prescreen.load_index(blast_db)
+    cache = None
+    if args.annot_cache is not None:
+        cache = ins_annot_cache.annot_cache(args.annot_cache,
+            ins_annot_cache.db_fingerprint(blast_db), args.annot_cache_size)
+    blast_shards = args.blast_shards
+    if blast_shards is None:
+        blast_shards = args.threads
+    ins_annot_dicts = [dict() for i in samples]
+    for svid, annot in annot_ins_fasta(cohort_fasta, blast_db, cohort_tmp,
+        args.threads, blast_shards, args.keep_blast_report, index, cache,
+        checkpoints):
+        n, svid = svid[1:].split("_", 1)
+        ins_annot_dicts[int(n)][svid] = annot
+    if cache is not None:
+        cache.close()
+        cache.report()
+
+    for (sample, vcf, bam), table, del_annot_dict, ins_annot_dict in zip(
+        samples, tables, del_annot_dicts, ins_annot_dicts):
+        reporter(table, del_annot_dict, ins_annot_dict,
+            "{}.{}".format(outfile, sample), args.bgzip, args.tabix,
+            args.annotated_vcf)
+    cohort_reporter([i[0] for i in samples], tables, del_annot_dicts,
+        ins_annot_dicts, outfile+".cohort.summary")
+
+
 def get_args():
     parser = argparse.ArgumentParser(description="Insertion sequence annotation"
         " for sniffles vcf", usage="%(prog)s [options]")
-    parser.add_argument("-v", "--vcf", help="sniffles vcf file"
-        " [default: %(default)s]", metavar="FILE")
+    parser.add_argument("-v", "--vcf", help="sniffles vcf file, plain or"
+        " gzip/bgzip [default: %(default)s]", metavar="FILE")
     parser.add_argument("-b", "--bam", help="bam file"
         " [default: %(default)s]", metavar="FILE")
     parser.add_argument("-o", "--outfile", help="Output file prefix"
         " [default: %(default)s]", metavar="STR")
+    parser.add_argument("-m", "--manifest", help="cohort mode, tab separated"
+        " [sample] vcf bam per line, instead of --vcf and --bam, output of a"
+        " sample is prefixed outfile.sample [default: %(default)s]",
+        metavar="FILE")
+    parser.add_argument("--region", help="only annotate records with POS in"
+        " chrom[:start[-end]], 1-based, may be given more than once. A bgzip"
+        " vcf with a tabix index is read from the region only"
+        " [default: %(default)s]", action="append", metavar="STR")
+    parser.add_argument("--regions-bed", help="only annotate records with"
+        " POS in the regions of a bed file [default: %(default)s]",
+        metavar="FILE")
+    parser.add_argument("--shard", help="only annotate shard i of N equal"
+        " genomic spans of the vcf contigs, 1-based, output is written to"
+        " outfile.shardiofN [default: %(default)s]", metavar="i/N")
+    parser.add_argument("--gather", help="merge outfile.shard1ofN .."
+        " outfile.shardNofN into outfile and outfile.summary, then exit",
+        type=int, metavar="N")
+    parser.add_argument("--del-engine", help="DEL annotation engine, index: "
+        "search rmsk index, sweep: stream coordinate sorted vcf and rmsk, "
+        "breakpoint: bisect rmsk records starting near the DEL start and "
+        "report the one with the closest breakpoints [default: %(default)s]",
+        choices=["index", "sweep", "breakpoint"], default="index")
+    parser.add_argument("-j", "--jobs", help="worker processes for index and "
+        "breakpoint DEL annotation, DELs are sharded by chromosome, and "
+        "sv_ins_seq runs of a cohort [default: %(default)s]",
+        type=int, default=1, metavar="INT")
+    parser.add_argument("--ins-seq-shards", help="split the INS records"
+        " into INT genomic chunks and run one sv_ins_seq on each at the same"
+        " time, stderr of chunk i is kept in outfile.tmp.ins.fasta.shard<i>"
+        ".log [default: %(default)s]", type=int, default=1, metavar="INT")
+    parser.add_argument("--max-consensus-reads", help="use at most INT insert"
+        " sequences per INS for consensus, reads in RNAMES first, then those"
+        " closest to SVLEN, 0 for all [default: %(default)s]", type=int,
+        default=0, metavar="INT")
+    parser.add_argument("-t", "--threads", help="blastn threads in total"
+        " [default: %(default)s]", type=int, default=1, metavar="INT")
+    parser.add_argument("--blast-shards", help="split insert sequences into"
+        " shards by bases and run one blastn on each, [default: threads]",
+        type=int, metavar="INT")
+    parser.add_argument("--keep-blast-report", help="write the raw blast"
+        " report to outfile.tmp.ins.blast.txt", action="store_true")
+    parser.add_argument("--prescreen", help="skip blast for insert"
+        " sequences sharing no minimizer with the blast database",
+        action="store_true")
+    parser.add_argument("--annot-cache", help="sqlite file caching insert"
+        " sequence annotations across runs [default: %(default)s]",
+        metavar="FILE")
+    parser.add_argument("--annot-cache-size", help="max sequences kept in"
+        " annotation cache [default: %(default)s]", type=int,
+        default=1000000, metavar="INT")
+    parser.add_argument("--bgzip", help="write the annotation table and"
+        " annotated vcf bgzip compressed, outfile.gz and outfile.vcf.gz",
+        action="store_true")
+    parser.add_argument("--tabix", help="also write tabix indexes of the"
+        " bgzip outputs, implies --bgzip, the vcf must be coordinate sorted",
+        action="store_true")
+    parser.add_argument("--annotated-vcf", help="also write outfile.vcf, the"
+        " vcf records with the DEL and INS annotation in INFO {}".format(
+        ANNOT_INFO), action="store_true")
+    parser.add_argument("--checkpoint", help="keep the intermediates"
+        " outfile.tmp.* of the DEL annotation, sv_ins_seq and blastn stages,"
+        " including the raw blast report, with checkpoints for --resume",
+        action="store_true")
+    parser.add_argument("--resume", help="skip the stages whose checkpointed"
+        " intermediates are up to date with their inputs, implies"
+        " --checkpoint", action="store_true")
+    parser.add_argument("--force-stage", help="run STAGE even if its"
+        " checkpoint is up to date, may be given more than once, implies"
+        " --checkpoint [default: %(default)s]", action="append",
+        choices=checkpoint.STAGES, metavar="STAGE")
+    parser.add_argument("--metrics", help="write time, cpu, peak memory and"
+        " counters of each stage to json FILE [default: %(default)s]",
+        metavar="FILE")
+    parser.add_argument("--profile-stages", help="comma separated stages to"
+        " profile with cProfile, stats are written to FILE.<stage>.prof of"
+        " --metrics, e.g. del_annot,blast,reporter [default: %(default)s]",
+        metavar="STR")
 
     if len(sys.argv) <= 1:
         parser.print_help()
@@ -106,26 +738,113 @@ def get_args():
 
 def main():
     args = get_args()
+    if args.metrics:
+        profile_stages = []
+        if args.profile_stages:
+            profile_stages = args.profile_stages.split(",")
+        metrics.enable(profile_stages, args.metrics)
+    try:
+        annot(args)
+    finally:
+        # also written for a failed run, failed stages are marked
+        metrics.write(args.metrics)
 
-    rmsk_db_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
-        "../database/rmsk.db")
 
-    del_annot_dict = dict()
-    for svid, annot in run_del_mei_annot(args.vcf, rmsk_db_file):
-        if annot != "Other":
-            del_annot_dict[svid] = annot
+def annot(args):
 
+    rmsk_db_file = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+        "../database/rmsk.db")
     blast_db = os.path.join(os.path.dirname(os.path.abspath(__file__)),
         "../database/Homo_sapiens.mei_virus.db.fasta")
-    
     c_sv_ins_seq = os.path.join(os.path.dirname(os.path.abspath(__file__)),
         "../build/bin/sv_ins_seq")
-    ins_annot_dict = dict()
-    for svid, annot in run_ins_annot(args.vcf, args.bam, blast_db,
-        args.outfile+".tmp", c_sv_ins_seq):
-        ins_annot_dict[svid] = annot
-    
-    reporter(args.vcf, del_annot_dict, ins_annot_dict, args.outfile)
+
+    if args.tabix:
+        args.bgzip = True
+
+    if args.gather:
+        gather(args.outfile, args.gather, args.bgzip, args.tabix,
+            args.annotated_vcf)
+        return
+
+    regions = None
+    if args.region or args.regions_bed:
+        regions = [vcf_reader.parse_region(i) for i in args.region or []]
+        if args.regions_bed:
+            regions += vcf_reader.read_regions_bed(args.regions_bed)
+
+    outfile = args.outfile
+    if args.shard:
+        if args.manifest:
+            raise RuntimeError("[mei_virals.annot] Error: --shard is not "
+                "supported with --manifest")
+        index, nshards = vcf_reader.parse_shard(args.shard)
+        contigs = vcf_reader.header_contigs(args.vcf)
+        other_contigs = contigs is not None
+        if contigs is None:
+            contigs = vcf_reader.vcf_contigs(args.vcf)
+        shard = vcf_reader.shard_regions(contigs, index, nshards,
+            other_contigs)
+        if regions is None:
+            regions = shard
+        else:
+            in_shard = vcf_reader.intersect_regions(regions, shard)
+            if other_contigs and index == nshards:
+                # regions on chromosomes without a ##contig line
+                declared = set([i[0] for i in contigs])
+                in_shard += [i for i in regions if i[0] not in declared]
+            regions = in_shard
+        outfile = shard_outfile(outfile, index, nshards)
+
+    # intermediates and checkpoints are only kept on request
+    checkpoints = None
+    if args.checkpoint or args.resume or args.force_stage:
+        checkpoints = checkpoint.policy(args.resume, args.force_stage or [])
+
+    if args.manifest:
+        run_cohort(read_manifest(args.manifest), args.outfile, rmsk_db_file,
+            blast_db, c_sv_ins_seq, args, regions, checkpoints)
+        return
+
+    # parse vcf once for all stages
+    table = vcf_table.vcf_table(args.vcf, regions=regions)
+
+    blast_shards = args.blast_shards
+    if blast_shards is None:
+        blast_shards = args.threads
+    # the first failure of DEL annotation or the INS chain stops the other
+    cancel = threading.Event()
+    with concurrent.futures.ThreadPoolExecutor(1) as executor:
+        # DEL annotation shares nothing with the sv_ins_seq -> blastn chain
+        # until reporter, run it meanwhile
+        del_future = executor.submit(collect_del_annot, table, rmsk_db_file,
+            args.del_engine, args.jobs, None, None, outfile+".tmp",
+            checkpoints, cancel)
+        del_future.add_done_callback(cancel_on_error(cancel))
+        ins_annot_dict = dict()
+        ins_annot = run_ins_annot(table, args.bam, blast_db,
+            outfile+".tmp", c_sv_ins_seq, args.threads, blast_shards,
+            args.keep_blast_report, args.prescreen, args.annot_cache,
+            args.annot_cache_size, checkpoints, args.ins_seq_shards,
+            args.max_consensus_reads, cancel)
+        try:
+            for svid, annot in ins_annot:
+                if cancel.is_set():
+                    # the DEL error is raised below
+                    break
+                ins_annot_dict[svid] = annot
+        except Exception:
+            if not cancel.is_set():
+                # the INS error is raised, stop DEL annotation
+                cancel.set()
+                raise
+        finally:
+            ins_annot.close()
+        # the DEL error, also when it cancelled the INS chain
+        del_annot_dict = del_future.result()
+
+    reporter(table, del_annot_dict, ins_annot_dict, outfile, args.bgzip,
+        args.tabix, args.annotated_vcf)
 
 if __name__ == "__main__":
     main()
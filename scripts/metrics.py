@@ -0,0 +1,175 @@
+"""
+Stage timing, counters and peak memory of an annotation run.
+
+Disabled by default: stage() returns a shared no-op context manager and
+count() returns at once, so instrumented code only pays a function call.
+enable() turns on recording, write() dumps a json metrics file and the
+cProfile stats of the stages chosen in enable().
+
+Stage cpu is the cpu time of the thread running it, since DEL annotation
+runs concurrently with the INS chain. Child cpu covers external programs
+(sv_ins_seq, blastn) and worker processes waited for in the stage. Peak rss
+can not be split between concurrent stages, a stage records the peak rss of
+the process and of its waited children so far at its exit,
+max_rss_so_far_kb and children_max_rss_so_far_kb. A stage that raised the
+peak shows it first, later stages repeat it.
+"""
+import sys
+import json
+import time
+import cProfile
+import resource
+import threading
+
+_enabled = False
+_lock = threading.Lock()
+_stages = dict()
+_counters = dict()
+_profilers = dict()
+_profile_prefix = None
+_start = None
+
+
+class _null_stage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_STAGE = _null_stage()
+
+
+def _children_cpu():
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+class _stage(object):
+    def __init__(self, name, calls=1):
+        self.name = name
+        self.calls = calls
+        self.profiler = _profilers.get(name)
+
+    def __enter__(self):
+        if self.profiler is not None:
+            try:
+                self.profiler.enable()
+            except ValueError as e:
+                # another profiler is active, e.g. in a concurrent stage
+                print("[metrics] Warning: Can not profile {}: {}".format(
+                    self.name, e), file=sys.stderr)
+                self.profiler = None
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        self.children_cpu = _children_cpu()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.perf_counter() - self.wall
+        cpu = time.thread_time() - self.cpu
+        children_cpu = _children_cpu() - self.children_cpu
+        if self.profiler is not None:
+            self.profiler.disable()
+        # peaks of the whole run so far, not of this stage alone
+        max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        children_max_rss = resource.getrusage(
+            resource.RUSAGE_CHILDREN).ru_maxrss
+        with _lock:
+            record = _stages.setdefault(self.name, {"calls": 0,
+                "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                "children_cpu_seconds": 0.0, "max_rss_so_far_kb": 0,
+                "children_max_rss_so_far_kb": 0, "failed": 0})
+            record["calls"] += self.calls
+            record["wall_seconds"] += wall
+            record["cpu_seconds"] += cpu
+            record["children_cpu_seconds"] += children_cpu
+            record["max_rss_so_far_kb"] = max(record["max_rss_so_far_kb"],
+                max_rss)
+            record["children_max_rss_so_far_kb"] = max(
+                record["children_max_rss_so_far_kb"], children_max_rss)
+            if exc_type is not None and exc_type is not GeneratorExit:
+                record["failed"] += 1
+        return False
+
+
+def enable(profile_stages=(), profile_prefix="metrics"):
+    """
+    start recording, cProfile stats of profile_stages are written to
+    profile_prefix.<stage>.prof
+    """
+    global _enabled, _profile_prefix, _start
+    _enabled = True
+    _profile_prefix = profile_prefix
+    _start = (time.perf_counter(), time.process_time())
+    for name in profile_stages:
+        _profilers[name] = cProfile.Profile()
+
+
+def enabled():
+    return _enabled
+
+
+def stage(name):
+    """
+    context manager timing the stage name, calls of a stage add up
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _stage(name)
+
+
+def stage_iter(name, iterable):
+    """
+    items of iterable, timing the stage name only while the next item is
+    produced, not while the consumer handles it. Counts as one call.
+    """
+    if not _enabled:
+        for item in iterable:
+            yield item
+        return
+    iterator = iter(iterable)
+    calls = 1
+    while True:
+        with _stage(name, calls):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        calls = 0
+        yield item
+
+
+def count(name, n=1):
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + n
+
+
+def report():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    with _lock:
+        result = {"wall_seconds": time.perf_counter() - _start[0],
+            "cpu_seconds": time.process_time() - _start[1],
+            "children_cpu_seconds": children.ru_utime + children.ru_stime,
+            "max_rss_kb": usage.ru_maxrss,
+            "children_max_rss_kb": children.ru_maxrss,
+            "stages": dict((i, dict(j)) for i, j in _stages.items()),
+            "counters": dict(_counters)}
+    return result
+
+
+def write(path):
+    """
+    write the json metrics to path and the cProfile stats of profiled stages
+    """
+    if not _enabled:
+        return
+    for name, profiler in _profilers.items():
+        if name in _stages:
+            profiler.dump_stats("{}.{}.prof".format(_profile_prefix, name))
+    with open(path, "w") as out_fp:
+        json.dump(report(), out_fp, indent=2, sort_keys=True)
+        print(file=out_fp)
@@ -0,0 +1,225 @@
+"""
+Binary cache of the parsed rmsk database.
+
+The cache is built once from the formated rmsk file and stores, for each
+chromosome and bin level, the start sorted interval arrays of
+bin_index.SortedBinIndex plus a one byte family code. It is memory mapped on
+load, so opening it does not parse any text.
+
+Layout: MAGIC, 8 bytes little endian header length, json header, arrays.
+The header records the size, mtime and sha1 of the source file, a cache with
+a different size, or a different mtime and sha1, is stale and rebuilt. A
+cache whose source only has a new mtime, e.g. touched or copied, gets the new
+mtime in its header so that the source is hashed once. It also records the
+families kept in the cache, a cache of other families is stale.
+"""
+import os
+import sys
+import json
+import mmap
+import shutil
+import struct
+import hashlib
+import logging
+from array import array
+
+import bin_index
+
+MAGIC = b"RMSKCACHE1\n"
+# array typecode and item size of each column
+COLUMNS = (("starts", "i", 4), ("ends", "i", 4), ("ranks", "i", 4),
+    ("codes", "b", 1))
+
+
+def cache_path(rmsk_file):
+    return rmsk_file + ".cache"
+
+
+def file_sha1(path, sha1=None):
+    """
+    add the content of path to sha1, a hashlib object, a new one if None,
+    and return its hex digest
+    """
+    if sha1 is None:
+        sha1 = hashlib.sha1()
+    with open(path, "rb") as io:
+        for block in iter(lambda: io.read(1 << 20), b""):
+            sha1.update(block)
+    return sha1.hexdigest()
+
+
+def fingerprint(path):
+    stat = os.stat(path)
+    return {"size": stat.st_size, "mtime": stat.st_mtime_ns,
+        "sha1": file_sha1(path)}
+
+
+def encode_header(header, magic=MAGIC):
+    """
+    json header padded to keep the arrays after it 8 bytes aligned
+    """
+    text = json.dumps(header).encode()
+    return text + b" " * (-(len(magic) + 8 + len(text)) % 8)
+
+
+def read_header(io, magic=MAGIC):
+    """
+    json header of a cache file starting with magic, None if it does not
+    """
+    if io.read(len(magic)) != magic:
+        return None
+    header_len = struct.unpack("<Q", io.read(8))[0]
+    return json.loads(io.read(header_len).decode())
+
+
+def source_fresh(source, recorded):
+    """
+    true if source matches its recorded fingerprint, by size and mtime, or
+    by size and sha1 if it was touched or copied
+    """
+    stat = os.stat(source)
+    if stat.st_size != recorded["size"]:
+        return 0
+    if stat.st_mtime_ns == recorded["mtime"]:
+        return 1
+    return file_sha1(source) == recorded["sha1"]
+
+
+def is_fresh(source, header, keep=None):
+    if header.get("keep") != keep:
+        return 0
+    return source_fresh(source, header["source"])
+
+
+def write_cache(source, cache_file, db, families, keep=None):
+    """
+    db is a dict of chrom: BinIndex or CompactBinIndex with family names as
+    interval data, families is the list of family names, a family code is
+    its position, keep is the sorted list of families loaded in db, None for
+    all
+    """
+    family_code = dict((j, i) for i, j in enumerate(families))
+    chroms = dict()
+    blocks = []
+    offset = 0
+    for chrom in sorted(db):
+        _sorted = db[chrom].to_sorted()
+        levels = []
+        for shift, max_span, starts, ends, ranks, codes in _sorted.levels:
+            columns = {"starts": array("i", starts),
+                "ends": array("i", ends), "ranks": array("i", ranks),
+                "codes": array("b", [family_code[_sorted.code_data(i)]
+                    for i in codes])}
+            level = {"shift": shift, "max_span": max_span,
+                "n": len(starts)}
+            for name, typecode, size in COLUMNS:
+                level[name] = offset
+                data = columns[name].tobytes()
+                # keep every column 8 bytes aligned
+                data += b"\0" * (-len(data) % 8)
+                blocks.append(data)
+                offset += len(data)
+            levels.append(level)
+        chroms[chrom] = levels
+    header = encode_header({"source": fingerprint(source),
+        "families": families, "keep": keep, "chroms": chroms})
+
+    tmp = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(tmp, "wb") as io:
+        io.write(MAGIC)
+        io.write(struct.pack("<Q", len(header)))
+        io.write(header)
+        for data in blocks:
+            io.write(data)
+    os.replace(tmp, cache_file)
+
+
+def update_mtime(cache_file, header, mtime, magic=MAGIC):
+    """
+    record mtime as the source mtime in the header of a fresh cache, the
+    cache is rewritten with its arrays copied as is
+    """
+    header = dict(header, source=dict(header["source"], mtime=mtime))
+    text = encode_header(header, magic)
+    tmp = "{}.{}.tmp".format(cache_file, os.getpid())
+    with open(cache_file, "rb") as io, open(tmp, "wb") as out_fp:
+        read_header(io, magic)
+        out_fp.write(magic)
+        out_fp.write(struct.pack("<Q", len(text)))
+        out_fp.write(text)
+        shutil.copyfileobj(io, out_fp)
+    os.replace(tmp, cache_file)
+
+
+class rmsk_cache(object):
+    """
+    memory mapped cache, get returns the bin_index.SortedBinIndex of a
+    chromosome, which is only created on first call
+    """
+    def __init__(self, cache_file):
+        self.cache_file = cache_file
+        with open(cache_file, "rb") as io:
+            self.header = read_header(io)
+            if self.header is None:
+                raise RuntimeError("[rmsk_cache] Error: {} is not a rmsk "
+                    "cache file".format(cache_file))
+            data_start = io.tell()
+            self._mmap = mmap.mmap(io.fileno(), 0, access=mmap.ACCESS_READ)
+        self.families = self.header["families"]
+        self._buffer = memoryview(self._mmap)[data_start:]
+
+    @property
+    def chroms(self):
+        return sorted(self.header["chroms"])
+
+    def get(self, chrom):
+        if chrom not in self.header["chroms"]:
+            return None
+        groups = []
+        for level in self.header["chroms"][chrom]:
+            columns = []
+            for name, typecode, size in COLUMNS:
+                start = level[name]
+                columns.append(self._buffer[start:start+level["n"]*size].cast(
+                    typecode))
+            groups.append([level["shift"], level["max_span"]] + columns)
+        return bin_index.SortedBinIndex(groups, data=self.families)
+
+
+def open_cache(source, keep=None):
+    """
+    return the rmsk_cache of source with families keep, or None if it is
+    missing or stale
+    """
+    cache_file = cache_path(source)
+    if not os.path.exists(cache_file):
+        return None
+    try:
+        mtime = os.stat(source).st_mtime_ns
+        with open(cache_file, "rb") as io:
+            header = read_header(io)
+        if header is None or not is_fresh(source, header, keep):
+            return None
+        if header["source"]["mtime"] != mtime:
+            try:
+                update_mtime(cache_file, header, mtime)
+            except OSError as e:
+                logging.warning("[rmsk_cache] Can not update cache {}: "
+                    "{}".format(cache_file, e))
+        return rmsk_cache(cache_file)
+    except (OSError, ValueError, KeyError, struct.error) as e:
+        logging.warning("[rmsk_cache] Can not read cache {}: {}".format(
+            cache_file, e))
+        return None
+
+
+def main():
+    if len(sys.argv) < 2:
+        print("Usage: python3 {} <rmsk_formated>".format(sys.argv[0]))
+        sys.exit(1)
+    import del_mei_annot
+    # build the cache if it is missing or stale
+    del_mei_annot.rmsk_db().loadDB(sys.argv[1])
+
+if __name__ == "__main__":
+    main()
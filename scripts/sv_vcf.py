@@ -128,6 +128,181 @@ class sv_vcf_record(object):
         return _sv_dict
 
 
+def _info_value(info, key):
+    """
+    value of key in an INFO string without splitting it, None if missing
+    """
+    key = key + "="
+    start = 0
+    while True:
+        i = info.find(key, start)
+        if i < 0:
+            return None
+        if i == 0 or info[i-1] == ";":
+            j = info.find(";", i)
+            if j < 0:
+                j = len(info)
+            return info[i+len(key):j]
+        start = i + 1
+
+
+def prefilter(line, svtypes=("DEL", "INS")):
+    """
+    cheap test on a raw vcf record line, return 0 only if the svtype of the
+    record can not be in svtypes, 1 if a record need to be built to tell
+    """
+    accept = set(svtypes)
+    if "INV" in accept or "TRA" in accept:
+        accept.add("BND") # BND is resolved as INV or TRA
+    found = 0
+    start = 0
+    while True:
+        i = line.find("SVTYPE=", start)
+        if i < 0:
+            break
+        start = i + 7
+        if i > 0 and line[i-1] not in ";\t":
+            continue
+        j = start
+        while j < len(line) and line[j] not in ";\t\n":
+            j += 1
+        if line[start:j] in accept:
+            return 1
+        found = 1
+    return 0 if found else 1
+
+
+class lazy_sv_vcf_record(object):
+    """
+    sv_vcf_record with the same attributes, INFO is decoded only for the
+    attributes accessed, and the record line is not kept
+    """
+    __slots__ = ("chrom1", "id", "ref", "alt", "qual", "filter", "info",
+        "_pos", "_rest", "_info_dict", "_svtype", "_pos1", "_chrom2",
+        "_pos2")
+
+    def __init__(self, record):
+        fields = record.strip().split("\t", 8)
+        (self.chrom1, self._pos, self.id, self.ref, self.alt, self.qual,
+            self.filter, self.info) = fields[:8]
+        if len(fields) > 8:
+            self._rest = fields[8]
+        else:
+            self._rest = ""
+        self._info_dict = None
+        self._svtype = None
+
+    @property
+    def format(self):
+        return self._rest.split("\t")[0]
+
+    @property
+    def sample_formats(self):
+        return self._rest.split("\t")[1:]
+
+    @property
+    def info_dict(self):
+        if self._info_dict is None:
+            self._info_dict = {}
+            for i in self.info.split(";"):
+                if "=" in i:
+                    info_id,info_value = i.split("=")
+                    self._info_dict[info_id] = info_value
+                else:
+                    self._info_dict[i] = i
+        return self._info_dict
+
+    def info_get(self, key):
+        if self._info_dict is not None:
+            return self._info_dict.get(key)
+        return _info_value(self.info, key)
+
+    def _info_required(self, key):
+        value = self.info_get(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def _resolve(self):
+        svtype = self._info_required("SVTYPE")
+        pos1 = self._pos
+        # BND, svtype, pos2
+        if svtype == "BND":
+            bnd_pos = bnd(self.alt) # BND position
+            chrom2 = bnd_pos.chrom
+            pos2 = bnd_pos.pos_num
+            if (self.chrom1 == chrom2 and (bnd_pos.stat == "s2"
+                    or bnd_pos.stat == "s4")): # INV
+                svtype = "INV"
+            elif self.chrom1 != chrom2:
+                svtype = "TRA"
+        elif svtype == "TRA": # sniffles TRA (BND not specified)
+            chrom2 = self._info_required("CHR2")
+            pos2 = self._info_required("END")
+        else:
+            chrom2 = self.chrom1
+            pos2 = self._info_required("END")
+            # exchange pos1 and pos2, if pos1 > pos2
+            if int(pos1) > int(pos2):
+                pos1, pos2 = pos2, pos1
+        self._svtype = svtype
+        self._pos1 = pos1
+        self._chrom2 = chrom2
+        self._pos2 = pos2
+
+    @property
+    def svtype(self):
+        if self._svtype is None:
+            self._resolve()
+        return self._svtype
+
+    @property
+    def pos1(self):
+        if self._svtype is None:
+            self._resolve()
+        return self._pos1
+
+    @property
+    def chrom2(self):
+        if self._svtype is None:
+            self._resolve()
+        return self._chrom2
+
+    @property
+    def pos2(self):
+        if self._svtype is None:
+            self._resolve()
+        return self._pos2
+
+    @property
+    def svlen(self):
+        svlen = self.info_get("SVLEN")
+        if svlen is None:
+            # INS, TRA do not have SVLEN attribute
+            return 0
+        return abs(int(svlen))
+
+    @property
+    def re(self):
+        _re = self.info_get("RE")
+        if _re is not None: # sniffles and picky
+            return _re
+        rt = self.info_get("RT")
+        if rt is not None: # nanosv
+            return str(sum([int(i) for i in rt.split(",")]))
+        return "NA"
+
+    @property
+    def sv_dict(self):
+        key_string = "{}_{}_{}-{}_{}".format(
+                self.svtype,
+                self.chrom1,
+                self.pos1,
+                self.chrom2,
+                self.pos2)
+        return {key_string: self}
+
+
 def main():
     #test
     pass
@@ -0,0 +1,329 @@
+"""
+Buffered output of tab separated tables and vcfs.
+
+Rows are formatted and written in batches instead of one print per line.
+Output is bgzip compressed when the path ends with .gz, which gzip, zcat
+and htslib read, and a compressed output can be tabix indexed (.tbi) for
+coordinate sorted rows. Both are done in pure python, no bgzip or tabix
+program is needed.
+"""
+import os
+import zlib
+import struct
+import logging
+import collections
+
+BATCH_LINES = 8192
+
+# uncompressed bytes per bgzf block, as bgzip
+BGZF_BLOCK_SIZE = 0xff00
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000"
+    "000000")
+
+# htslib tbx_conf_t: format, sequence, begin and end columns (1-based),
+# meta char and skipped lines. format 0 is generic 1-based, 2 is vcf.
+tabix_conf = collections.namedtuple("tabix_conf", ["format", "col_seq",
+    "col_beg", "col_end", "meta", "skip"])
+TABIX_VCF = tabix_conf(2, 1, 2, 0, "#", 0)
+# chrom1, pos1, chrom2, pos2, ... of reporter
+TABIX_BEDPE = tabix_conf(0, 1, 2, 4, "#", 0)
+# htslib: bins spanning less compressed data are merged into their parent
+MIN_MARKER_DIST = 0x10000
+# htslib pseudo-bin of the offsets and record count of a sequence
+META_BIN = 37450
+
+
+class bgzf_writer(object):
+    """
+    bgzip compressed file, tell() is the virtual offset of the next byte
+    """
+    def __init__(self, path, level=6):
+        self._io = open(path, "wb")
+        self._level = level
+        self._buffer = bytearray()
+        self._coffset = 0
+
+    def _write_block(self, data):
+        compressor = zlib.compressobj(self._level, zlib.DEFLATED, -15)
+        cdata = compressor.compress(data) + compressor.flush()
+        block = b"".join([struct.pack("<4BI2BH2BHH", 0x1f, 0x8b, 8, 4, 0, 0,
+            0xff, 6, 66, 67, 2, len(cdata) + 25), cdata,
+            struct.pack("<II", zlib.crc32(data), len(data))])
+        self._io.write(block)
+        self._coffset += len(block)
+
+    def write(self, data):
+        self._buffer += data
+        if len(self._buffer) >= BGZF_BLOCK_SIZE:
+            view = memoryview(self._buffer)
+            n = len(self._buffer) // BGZF_BLOCK_SIZE * BGZF_BLOCK_SIZE
+            for i in range(0, n, BGZF_BLOCK_SIZE):
+                self._write_block(view[i:i+BGZF_BLOCK_SIZE])
+            view.release()
+            del self._buffer[:n]
+
+    def tell(self):
+        return (self._coffset << 16) | len(self._buffer)
+
+    def flush(self):
+        """
+        write the pending data as a block, tell() is then the next block
+        """
+        if self._buffer:
+            self._write_block(bytes(self._buffer))
+            self._buffer = bytearray()
+
+    def close(self):
+        self.flush()
+        self._io.write(BGZF_EOF)
+        self._io.close()
+
+
+def reg2bin(beg, end):
+    """
+    smallest bin holding 0-based [beg, end)
+    """
+    end -= 1
+    for shift, offset in ((14, 4681), (17, 585), (20, 73), (23, 9),
+        (26, 1)):
+        if beg >> shift == end >> shift:
+            return offset + (beg >> shift)
+    return 0
+
+
+def bin_first(level):
+    """
+    first bin of level, 0 is the whole sequence and 5 the 16kb bins
+    """
+    return ((1 << 3*level) - 1) // 7
+
+
+def compress_bins(bins):
+    """
+    as htslib, merge the chunks of a bin spanning less than MIN_MARKER_DIST
+    compressed bytes into its parent if the parent has chunks, then merge
+    chunks beginning in the bgzf block the previous one ends in
+    """
+    for level in range(5, 0, -1):
+        first = bin_first(level)
+        for bin_num in sorted(bins):
+            if not first <= bin_num < bin_first(level + 1):
+                continue
+            chunks = bins[bin_num]
+            if level < 5:
+                chunks.sort()
+            parent = (bin_num - 1) >> 3
+            if parent in bins and (chunks[-1][1] >> 16) - (chunks[0][0] >>
+                16) < MIN_MARKER_DIST:
+                bins[parent].extend(bins.pop(bin_num))
+    for bin_num in bins:
+        chunks = sorted(bins[bin_num])
+        merged = [chunks[0]]
+        for chunk in chunks[1:]:
+            if merged[-1][1] >> 16 >= chunk[0] >> 16:
+                merged[-1][1] = max(merged[-1][1], chunk[1])
+            else:
+                merged.append(chunk)
+        bins[bin_num] = merged
+
+
+class tabix_builder(object):
+    """
+    tabix index of records added in coordinate order. Bins, linear index and
+    the META_BIN pseudo-bin are finished as tabix -p does.
+    """
+    def __init__(self, conf):
+        self.conf = conf
+        self.names = []
+        self.bins = []
+        self.ioffs = []
+        # first and last virtual offset and number of records of sequences
+        self.meta = []
+        self.sorted = True
+        self._last = None
+        self._last_chunk = None
+
+    def add(self, chrom, beg, end, voffset_beg, voffset_end):
+        """
+        record on 0-based [beg, end) of chrom between two virtual offsets
+        """
+        if self._last is None or chrom != self._last[0]:
+            if chrom in self.names:
+                self.sorted = False
+            self.names.append(chrom)
+            self.bins.append(dict())
+            self.ioffs.append([])
+            self.meta.append([voffset_beg, voffset_end, 0])
+        elif beg < self._last[1]:
+            self.sorted = False
+        self._last = (chrom, beg)
+        if not self.sorted:
+            return
+        end = max(end, beg + 1)
+        meta = self.meta[-1]
+        meta[1] = voffset_end
+        meta[2] += 1
+        chunks = self.bins[-1].setdefault(reg2bin(beg, end), [])
+        if chunks and chunks[-1][1] == voffset_beg:
+            chunks[-1][1] = voffset_end
+        else:
+            chunks.append([voffset_beg, voffset_end])
+        self._last_chunk = chunks[-1]
+        ioff = self.ioffs[-1]
+        last_window = (end - 1) >> 14
+        if len(ioff) <= last_window:
+            ioff.extend([None] * (last_window + 1 - len(ioff)))
+        for window in range(beg >> 14, last_window + 1):
+            if ioff[window] is None:
+                ioff[window] = voffset_beg
+
+    def end_at(self, voffset):
+        """
+        the last record ends at voffset, the next block once its own is
+        written, as htslib reads it
+        """
+        if self._last_chunk is not None:
+            self._last_chunk[1] = voffset
+            self.meta[-1][1] = voffset
+
+    def write(self, tbi):
+        names = b"".join([i.encode() + b"\0" for i in self.names])
+        parts = [b"TBI\1", struct.pack("<8i", len(self.names),
+            self.conf.format, self.conf.col_seq, self.conf.col_beg,
+            self.conf.col_end, ord(self.conf.meta), self.conf.skip,
+            len(names)), names]
+        for bins, ioff, meta in zip(self.bins, self.ioffs, self.meta):
+            compress_bins(bins)
+            bins[META_BIN] = [meta[:2], [meta[2], 0]]
+            parts.append(struct.pack("<i", len(bins)))
+            for bin_num in sorted(bins):
+                chunks = bins[bin_num]
+                parts.append(struct.pack("<Ii", bin_num, len(chunks)))
+                parts.append(struct.pack("<{}Q".format(2*len(chunks)),
+                    *[j for i in chunks for j in i]))
+            # windows without a record start where the next one does
+            for i in range(len(ioff) - 2, -1, -1):
+                if ioff[i] is None:
+                    ioff[i] = ioff[i+1]
+            parts.append(struct.pack("<i{}Q".format(len(ioff)), len(ioff),
+                *ioff))
+        # no records without coordinates
+        parts.append(struct.pack("<Q", 0))
+        out = bgzf_writer(tbi)
+        out.write(b"".join(parts))
+        out.close()
+
+
+class table_writer(object):
+    """
+    buffered writer of lines and rows. path ending with .gz is bgzip
+    compressed, index is a tabix_conf to also write path.tbi, which needs
+    compression and rows sorted by the sequence and begin columns.
+    """
+    def __init__(self, path, index=None, batch_lines=BATCH_LINES):
+        self.path = path
+        self.compress = path.endswith(".gz")
+        if index is not None and not self.compress:
+            raise RuntimeError("[table_writer] Error: Can not tabix index "
+                "{}, it is not bgzip compressed".format(path))
+        self.index = None
+        if index is not None:
+            self.index = tabix_builder(index)
+        self.batch_lines = batch_lines
+        self._batch = []
+        self._template = None
+        if self.compress:
+            self._out = bgzf_writer(path)
+        else:
+            self._out = open(path, "wb", buffering=1 << 20)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+        return False
+
+    def write(self, text):
+        """
+        unindexed text such as header lines
+        """
+        self._flush()
+        self._out.write(text.encode())
+
+    def write_lines(self, lines):
+        """
+        lines ending with a newline
+        """
+        batch = self._batch
+        for line in lines:
+            batch.append(line)
+            if len(batch) >= self.batch_lines:
+                self._flush()
+
+    def write_rows(self, rows):
+        """
+        rows are sequences of fields, written as str() of each field
+        """
+        batch = self._batch
+        for row in rows:
+            if self._template is None:
+                self._template = "\t".join(["%s"] * len(row)) + "\n"
+            batch.append(self._template % tuple(row))
+            if len(batch) >= self.batch_lines:
+                self._flush()
+
+    def _key(self, line):
+        """
+        sequence and 0-based [begin, end) of an indexed line
+        """
+        conf = self.index.conf
+        fields = line.split("\t", max(conf.col_seq, conf.col_beg,
+            conf.col_end, 8 if conf.format == 2 else 0))
+        chrom = fields[conf.col_seq-1]
+        beg = int(fields[conf.col_beg-1]) - 1
+        if conf.format == 2:
+            # as htslib: END of INFO, else the length of REF
+            end = beg + len(fields[3])
+            info = fields[7]
+            i = info.find("END=")
+            while i > 0 and info[i-1] != ";":
+                i = info.find("END=", i + 1)
+            if i >= 0:
+                end = max(end, int(info[i+4:].split(";", 1)[0]))
+        elif conf.col_end:
+            end = int(fields[conf.col_end-1])
+        else:
+            end = beg + 1
+        return chrom, beg, end
+
+    def _flush(self):
+        if not self._batch:
+            return
+        if self.index is None:
+            self._out.write("".join(self._batch).encode())
+        else:
+            out = self._out
+            for line in self._batch:
+                voffset = out.tell()
+                out.write(line.encode())
+                chrom, beg, end = self._key(line)
+                self.index.add(chrom, beg, end, voffset, out.tell())
+        del self._batch[:]
+
+    def close(self):
+        self._flush()
+        if self.index is not None:
+            self._out.flush()
+            self.index.end_at(self._out.tell())
+        self._out.close()
+        if self.index is None:
+            return
+        tbi = self.path + ".tbi"
+        if self.index.sorted:
+            self.index.write(tbi)
+        else:
+            logging.warning("[table_writer] {} is not sorted by coordinate, "
+                "no tabix index is written".format(self.path))
+            if os.path.exists(tbi):
+                os.remove(tbi)
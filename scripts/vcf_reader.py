@@ -0,0 +1,444 @@
+"""
+Plain, gzip and bgzip vcf input, optionally restricted to regions.
+
+A region is chrom, chrom:start or chrom:start-end, 1-based and inclusive as
+in samtools/tabix, or a line of a bed file. A record is in a region if its
+POS is. When a bgzip vcf has a tabix index (vcf.gz.tbi) the records of each
+region are read by seeking to the index chunks, otherwise the whole file is
+streamed and filtered. The chrom OTHER_CONTIGS, "*", stands for every
+chromosome without a ##contig line in the vcf header.
+"""
+import os
+import gzip
+import zlib
+import bisect
+import struct
+import logging
+
+# tabix can not index beyond 2^29
+MAX_POS = 1 << 29
+# not a valid contig name in vcf
+OTHER_CONTIGS = "*"
+
+
+def is_gzip(path):
+    with open(path, "rb") as io:
+        return io.read(2) == b"\x1f\x8b"
+
+
+def parse_region(region):
+    """
+    chrom[:start[-end]] to (chrom, start, end), 1-based inclusive
+    """
+    region = region.strip()
+    if ":" not in region:
+        return region, 1, MAX_POS
+    chrom, span = region.rsplit(":", 1)
+    span = span.replace(",", "")
+    try:
+        if "-" in span:
+            start, end = span.split("-", 1)
+            start = int(start)
+            end = int(end) if end else MAX_POS
+        else:
+            start = int(span)
+            end = MAX_POS
+    except ValueError:
+        raise RuntimeError("[vcf_reader] Error: Invalid region {}".format(
+            region))
+    if start < 1 or end < start:
+        raise RuntimeError("[vcf_reader] Error: Invalid region {}".format(
+            region))
+    return chrom, start, end
+
+
+def read_regions_bed(bed):
+    """
+    regions of a bed file, 0-based half open, as 1-based inclusive
+    """
+    regions = []
+    with open(bed, "r") as io:
+        for line in io:
+            if (not line.strip() or line[0] == "#" or
+                line.startswith(("track", "browser"))):
+                continue
+            fields = line.strip().split("\t")
+            regions.append((fields[0], int(fields[1]) + 1, int(fields[2])))
+    return regions
+
+
+def merge_regions(regions):
+    """
+    dict of chrom: sorted, non overlapping [(start, end)]
+    """
+    by_chrom = dict()
+    for chrom, start, end in regions:
+        by_chrom.setdefault(chrom, []).append((start, end))
+    for chrom in by_chrom:
+        merged = []
+        for start, end in sorted(by_chrom[chrom]):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        by_chrom[chrom] = merged
+    return by_chrom
+
+
+class bgzf_reader(object):
+    """
+    lines of a bgzip file from a virtual offset, coffset << 16 | uoffset
+    """
+    def __init__(self, path):
+        self._io = open(path, "rb")
+        self._block = b""
+        self._coffset = 0
+        self._next = 0
+        self._pos = 0
+
+    def close(self):
+        self._io.close()
+
+    def _load(self, coffset):
+        self._io.seek(coffset)
+        header = self._io.read(18)
+        if len(header) < 18:
+            self._block = b""
+            self._coffset = self._next = coffset
+            return 0
+        if header[:4] != b"\x1f\x8b\x08\x04" or header[12:14] != b"BC":
+            raise RuntimeError("[bgzf_reader] Error: {} is not bgzip "
+                "compressed".format(self._io.name))
+        bsize = struct.unpack("<H", header[16:18])[0] + 1
+        self._block = zlib.decompress(header + self._io.read(bsize - 18), 31)
+        self._coffset = coffset
+        self._next = coffset + bsize
+        return 1
+
+    def seek(self, voffset):
+        self._load(voffset >> 16)
+        self._pos = voffset & 0xFFFF
+
+    def tell(self):
+        if self._pos >= len(self._block):
+            return self._next << 16
+        return (self._coffset << 16) | self._pos
+
+    def readline(self):
+        parts = []
+        while True:
+            if self._pos >= len(self._block):
+                if not self._load(self._next):
+                    break
+                self._pos = 0
+                continue
+            i = self._block.find(b"\n", self._pos)
+            if i < 0:
+                parts.append(self._block[self._pos:])
+                self._pos = len(self._block)
+                continue
+            parts.append(self._block[self._pos:i+1])
+            self._pos = i + 1
+            break
+        return b"".join(parts)
+
+
+class tabix_index(object):
+    """
+    bins and linear index of each sequence of a .tbi file
+    """
+    def __init__(self, tbi):
+        with gzip.open(tbi, "rb") as io:
+            data = io.read()
+        if data[:4] != b"TBI\x01":
+            raise RuntimeError("[tabix_index] Error: {} is not a tabix "
+                "index".format(tbi))
+        n_ref, fmt, col_seq, col_beg, col_end, meta, skip, l_nm = \
+            struct.unpack_from("<8i", data, 4)
+        offset = 36
+        names = data[offset:offset+l_nm].split(b"\0")
+        self.names = [i.decode() for i in names if i]
+        offset += l_nm
+        self.bins = []
+        self.ioffs = []
+        for i in range(n_ref):
+            n_bin = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            bins = dict()
+            for j in range(n_bin):
+                bin_num, n_chunk = struct.unpack_from("<Ii", data, offset)
+                offset += 8
+                chunks = struct.unpack_from("<{}Q".format(2*n_chunk), data,
+                    offset)
+                offset += 16*n_chunk
+                bins[bin_num] = list(zip(chunks[0::2], chunks[1::2]))
+            n_intv = struct.unpack_from("<i", data, offset)[0]
+            offset += 4
+            self.ioffs.append(struct.unpack_from("<{}Q".format(n_intv),
+                data, offset))
+            offset += 8*n_intv
+            self.bins.append(bins)
+        self.tid = dict((j, i) for i, j in enumerate(self.names))
+
+    @staticmethod
+    def reg2bins(beg, end):
+        """
+        bins overlapping 0-based [beg, end)
+        """
+        end -= 1
+        bins = [0]
+        for shift, offset in ((26, 1), (23, 9), (20, 73), (17, 585),
+            (14, 4681)):
+            bins.extend(range(offset + (beg >> shift),
+                offset + (end >> shift) + 1))
+        return bins
+
+    def chunks(self, chrom, beg, end):
+        """
+        merged (begin, end) virtual offsets of chunks that may hold records
+        overlapping 0-based [beg, end) of chrom
+        """
+        tid = self.tid.get(chrom)
+        if tid is None:
+            return []
+        bins = self.bins[tid]
+        ioff = self.ioffs[tid]
+        min_off = 0
+        if ioff:
+            min_off = ioff[min(beg >> 14, len(ioff) - 1)]
+        chunks = []
+        for bin_num in self.reg2bins(beg, end):
+            for chunk in bins.get(bin_num, ()):
+                if chunk[1] > min_off:
+                    chunks.append(chunk)
+        chunks.sort()
+        merged = []
+        for chunk_beg, chunk_end in chunks:
+            if merged and chunk_beg <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], chunk_end))
+            else:
+                merged.append((chunk_beg, chunk_end))
+        return merged
+
+
+class vcf_reader(object):
+    """
+    lines of a plain, gzip or bgzip vcf, header lines first. With regions,
+    a list of (chrom, start, end), only records with POS in a region are
+    given, in file order.
+    """
+    def __init__(self, vcf, regions=None):
+        self.vcf = vcf
+        self.regions = None
+        if regions is not None:
+            self.regions = merge_regions(regions)
+        # ##contig ids of the header, read before the records
+        self._declared = set()
+        self._warned = set()
+        self.gzip = is_gzip(vcf)
+        self.tbi = None
+        if self.regions is not None and self.gzip and os.path.exists(
+            vcf + ".tbi"):
+            self.tbi = vcf + ".tbi"
+
+    def _open(self):
+        if self.gzip:
+            return gzip.open(self.vcf, "rt")
+        return open(self.vcf, "r")
+
+    def _header_line(self, line):
+        if line.startswith("##contig=<"):
+            self._declared.add(contig_fields(line).get("ID"))
+
+    def _other_spans(self, chrom):
+        """
+        spans of OTHER_CONTIGS for chrom if it is not declared, else None
+        """
+        spans = self.regions.get(OTHER_CONTIGS)
+        if spans is None or chrom in self._declared:
+            return None
+        if chrom not in self._warned:
+            self._warned.add(chrom)
+            logging.warning("[vcf_reader] {} has records on {} without a "
+                "##contig line".format(self.vcf, chrom))
+        return spans
+
+    def _in_regions(self, line):
+        chrom, pos = line.split("\t", 2)[:2]
+        spans = self.regions.get(chrom)
+        if spans is None:
+            spans = self._other_spans(chrom)
+            if spans is None:
+                return 0
+        pos = int(pos)
+        i = bisect.bisect_right(spans, (pos, MAX_POS + 1)) - 1
+        return i >= 0 and spans[i][0] <= pos <= spans[i][1]
+
+    def _stream(self):
+        with self._open() as io:
+            for line in io:
+                if line[0] == "#":
+                    self._header_line(line)
+                    yield line
+                elif self.regions is None or self._in_regions(line):
+                    yield line
+
+    def _seek(self):
+        index = tabix_index(self.tbi)
+        with self._open() as io:
+            for line in io:
+                if line[0] != "#":
+                    break
+                self._header_line(line)
+                yield line
+        regions = dict(self.regions)
+        regions.pop(OTHER_CONTIGS, None)
+        for chrom in index.names:
+            if chrom not in regions:
+                spans = self._other_spans(chrom)
+                if spans is not None:
+                    regions[chrom] = spans
+        reader = bgzf_reader(self.vcf)
+        try:
+            # file order of sequences
+            for chrom in sorted(regions, key=lambda x: index.tid.get(x, -1)):
+                if chrom not in index.tid:
+                    continue
+                for start, end in regions[chrom]:
+                    for chunk_beg, chunk_end in index.chunks(chrom,
+                        start - 1, end):
+                        reader.seek(chunk_beg)
+                        while reader.tell() < chunk_end:
+                            line = reader.readline()
+                            if not line:
+                                break
+                            line = line.decode()
+                            fields = line.split("\t", 2)
+                            if fields[0] != chrom:
+                                continue
+                            pos = int(fields[1])
+                            if pos > end:
+                                break
+                            if pos >= start:
+                                yield line
+        finally:
+            reader.close()
+
+    def __iter__(self):
+        if self.tbi is not None:
+            try:
+                index_ok = os.path.getmtime(self.tbi) >= os.path.getmtime(
+                    self.vcf)
+            except OSError:
+                index_ok = 0
+            if index_ok:
+                return self._seek()
+            logging.warning("[vcf_reader] {} is older than {}, stream the "
+                "whole file".format(self.tbi, self.vcf))
+        return self._stream()
+
+
+def contig_fields(line):
+    """
+    dict of the key=value fields of a ##contig header line
+    """
+    return dict(i.split("=", 1) for i in
+        line.strip()[len("##contig=<"):-1].split(",") if "=" in i)
+
+
+def header_contigs(vcf):
+    """
+    [(chrom, length)] of the ##contig lines of the vcf header, in header
+    order, None without a length for every contig
+    """
+    contigs = []
+    complete = 1
+    for line in vcf_reader(vcf):
+        if not line.startswith("##"):
+            break
+        if line.startswith("##contig=<"):
+            fields = contig_fields(line)
+            if "ID" not in fields or "length" not in fields:
+                complete = 0
+                continue
+            contigs.append((fields["ID"], int(fields["length"])))
+    if contigs and complete:
+        return contigs
+    return None
+
+
+def vcf_contigs(vcf):
+    """
+    header_contigs of vcf, else chromosomes in order of appearance with
+    their largest POS as length, which reads the file
+    """
+    contigs = header_contigs(vcf)
+    if contigs is not None:
+        return contigs
+    lengths = dict()
+    order = []
+    for line in vcf_reader(vcf):
+        if line[0] == "#":
+            continue
+        chrom, pos = line.split("\t", 2)[:2]
+        if chrom not in lengths:
+            order.append(chrom)
+            lengths[chrom] = 0
+        lengths[chrom] = max(lengths[chrom], int(pos))
+    return [(i, lengths[i]) for i in order]
+
+
+def parse_shard(shard):
+    """
+    i/N to (i, N), i is 1-based
+    """
+    try:
+        index, nshards = [int(i) for i in shard.split("/")]
+    except ValueError:
+        raise RuntimeError("[vcf_reader] Error: Invalid shard {}, expect "
+            "i/N".format(shard))
+    if nshards < 1 or not 1 <= index <= nshards:
+        raise RuntimeError("[vcf_reader] Error: Invalid shard {}, expect "
+            "1 <= i <= N".format(shard))
+    return index, nshards
+
+
+def shard_regions(contigs, index, nshards, other_contigs=False):
+    """
+    regions of shard index (1-based) of nshards equal spans of the genome,
+    contigs concatenated in order. Records past the given length of a
+    contig go with its last base. With other_contigs, contigs are those of
+    the header and records on chromosomes without a ##contig line go to the
+    last shard.
+    """
+    total = sum([i[1] for i in contigs])
+    lo = total*(index-1)//nshards
+    hi = total*index//nshards
+    regions = []
+    offset = 0
+    for chrom, length in contigs:
+        start = max(lo, offset) - offset + 1
+        end = min(hi, offset + length) - offset
+        if start <= end:
+            if end == length:
+                end = MAX_POS
+            regions.append((chrom, start, end))
+        offset += length
+    if other_contigs and index == nshards:
+        regions.append((OTHER_CONTIGS, 1, MAX_POS))
+    return regions
+
+
+def intersect_regions(regions, other):
+    """
+    regions in both lists of (chrom, start, end)
+    """
+    other = merge_regions(other)
+    result = []
+    for chrom, spans in merge_regions(regions).items():
+        for start, end in spans:
+            for o_start, o_end in other.get(chrom, []):
+                if o_start <= end and start <= o_end:
+                    result.append((chrom, max(start, o_start),
+                        min(end, o_end)))
+    return result
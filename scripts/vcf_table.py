@@ -0,0 +1,130 @@
+"""
+One pass vcf ingestion. The fields the pipeline needs of each DEL and INS
+record are kept in a compact column table, which is shared by DEL annotation,
+INS sequence extraction and reporter instead of parsing the vcf again.
+"""
+import sys
+import collections
+from array import array
+
+import sv_vcf
+import metrics
+import vcf_reader
+
+sv_row = collections.namedtuple("sv_row", ["id", "chrom1", "pos1", "chrom2",
+    "pos2", "svtype", "svlen", "alt"])
+
+
+class vcf_table(object):
+    """
+    id, chrom, pos, end, svtype, svlen and ALT of records of svtypes, as
+    sv_vcf.lazy_sv_vcf_record gives them, plus the offset and length of each
+    record line in the vcf. A gzip vcf, or a vcf restricted to regions (see
+    vcf_reader), is read through vcf_reader and offsets are the positions
+    of the record lines in its output instead.
+    """
+    def __init__(self, vcf, svtypes=("DEL", "INS"), regions=None):
+        self.vcf = vcf
+        self.svtypes = svtypes
+        self.regions = regions
+        self.seekable = regions is None and not vcf_reader.is_gzip(vcf)
+        self.header = []
+        self.ids = []
+        self.chroms = []
+        self.starts = array("l")
+        self.ends = array("l")
+        self.types = []
+        self.svlens = array("l")
+        self.alts = []
+        self.offsets = array("q")
+        self.lengths = array("l")
+        with metrics.stage("vcf_parse"):
+            self._load()
+        metrics.count("vcf_sv_records", len(self.ids))
+
+    def _lines(self):
+        """
+        (line, offset, length) of the vcf, line is bytes
+        """
+        if self.seekable:
+            with open(self.vcf, "rb") as io:
+                offset = 0
+                for line in io:
+                    yield line, offset, len(line)
+                    offset += len(line)
+            return
+        n = 0
+        for line in vcf_reader.vcf_reader(self.vcf, self.regions):
+            if line[0] == "#":
+                yield line.encode(), -1, 0
+            else:
+                yield line.encode(), n, 0
+                n += 1
+
+    def _load(self):
+        for line, offset, length in self._lines():
+            if line[:1] == b"#":
+                self.header.append(line)
+                continue
+            record = line.decode()
+            if not sv_vcf.prefilter(record, self.svtypes):
+                continue
+            sv = sv_vcf.lazy_sv_vcf_record(record)
+            if sv.svtype in self.svtypes:
+                self.ids.append(sv.id)
+                self.chroms.append(sys.intern(sv.chrom1))
+                self.starts.append(int(sv.pos1))
+                self.ends.append(int(sv.pos2))
+                self.types.append(sys.intern(sv.svtype))
+                self.svlens.append(sv.svlen)
+                if sv.alt[:1] == "<":
+                    self.alts.append(sys.intern(sv.alt))
+                else:
+                    self.alts.append(sv.alt)
+                self.offsets.append(offset)
+                self.lengths.append(length)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def row(self, i):
+        return sv_row(self.ids[i], self.chroms[i], self.starts[i],
+            self.chroms[i], self.ends[i], self.types[i], self.svlens[i],
+            self.alts[i])
+
+    def __iter__(self):
+        for i in range(len(self.ids)):
+            yield self.row(i)
+
+    def write_vcf(self, output, svtypes=None):
+        """
+        write the vcf header and the original lines of records of svtypes,
+        all records in the table if svtypes is None
+        """
+        if not self.seekable:
+            self._write_lines(output, svtypes)
+            return
+        with open(self.vcf, "rb") as io, open(output, "wb") as out:
+            for line in self.header:
+                out.write(line)
+            for i in range(len(self.ids)):
+                if svtypes is not None and self.types[i] not in svtypes:
+                    continue
+                io.seek(self.offsets[i])
+                line = io.read(self.lengths[i])
+                if not line.endswith(b"\n"):
+                    line += b"\n"
+                out.write(line)
+
+    def _write_lines(self, output, svtypes):
+        # records are picked by position in a second pass of vcf_reader
+        wanted = set(self.offsets[i] for i in range(len(self.ids))
+            if svtypes is None or self.types[i] in svtypes)
+        with open(output, "wb") as out:
+            for line in self.header:
+                out.write(line)
+            for line, n, length in self._lines():
+                if n in wanted:
+                    if not line.endswith(b"\n"):
+                        line += b"\n"
+                    out.write(line)
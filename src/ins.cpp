@@ -1,7 +1,7 @@
 #include "ins.h"
 
 ins::ins(bcf_hdr_t *vcf_h, bcf1_t *vcf_v, samFile *sam_fp,
-    bam_hdr_t *bam_h, hts_idx_t *bam_idx)
+    bam_hdr_t *bam_h, hts_idx_t *bam_idx, std::size_t max_reads)
 {
     chrom = bcf_hdr_id2name(vcf_h, vcf_v->rid);
     pos = vcf_v->pos;
@@ -37,6 +37,9 @@ ins::ins(bcf_hdr_t *vcf_h, bcf1_t *vcf_v, samFile *sam_fp,
     id = vcf_v->d.id;
 
     ins_sequences = get_ins_sequences(sam_fp, bam_h, bam_idx);
+    if (max_reads > 0 && ins_sequences.size() > max_reads) {
+        ins_sequences = select_sequences(ins_sequences, max_reads);
+    }
     consensus = get_consensus();
 }
 
@@ -115,7 +118,8 @@ std::shared_ptr<seq> ins::get_ins_sequence(bam_hdr_t *h, bam1_t *b)
         + std::to_string(ref_pos_vec[closest_idx]) + "/"
         + std::to_string(query_pos_vec[closest_idx]);
     std::string sequence = ins_seq_vec[closest_idx];
-    return std::shared_ptr<seq> (new seq(seq_name, sequence));
+    return std::shared_ptr<seq> (new seq(seq_name, sequence,
+        bam_get_qname(b)));
 }
 
 std::vector<std::shared_ptr<seq>> ins::get_ins_sequences(samFile *fp,
@@ -145,6 +149,39 @@ std::vector<std::shared_ptr<seq>> ins::get_ins_sequences(samFile *fp,
     return seqs;
 }
 
+// keep max_reads sequences for consensus, reads in RNAMES first, then those
+// with length closest to SVLEN, ties by bam order. Kept sequences stay in bam
+// order, so the selection and consensus do not depend on anything else.
+std::vector<std::shared_ptr<seq>> ins::select_sequences(
+    const std::vector<std::shared_ptr<seq>> &seqs, std::size_t max_reads)
+{
+    std::unordered_set<std::string> supporting(qnames.begin(), qnames.end());
+    std::vector<std::size_t> order(seqs.size());
+    std::vector<int> in_rnames(seqs.size());
+    std::vector<int64_t> size_diff(seqs.size());
+    for (std::size_t i = 0; i < seqs.size(); ++i) {
+        order[i] = i;
+        in_rnames[i] = supporting.count(seqs[i]->qname) > 0;
+        size_diff[i] = std::abs(static_cast<int64_t>(
+            seqs[i]->sequence.size()) - static_cast<int64_t>(std::abs(size)));
+    }
+    std::stable_sort(order.begin(), order.end(),
+        [&](std::size_t a, std::size_t b) {
+            if (in_rnames[a] != in_rnames[b]) {
+                return in_rnames[a] > in_rnames[b];
+            }
+            return size_diff[a] < size_diff[b];
+        });
+    order.resize(max_reads);
+    std::sort(order.begin(), order.end());
+
+    std::vector<std::shared_ptr<seq>> selected;
+    for (const auto &i: order) {
+        selected.push_back(seqs[i]);
+    }
+    return selected;
+}
+
 std::string ins::get_consensus() {
     if (ins_sequences.size() > 1) {
         auto alignment_engine = spoa::createAlignmentEngine(
@@ -7,6 +7,8 @@
 #include <string>
 #include <algorithm>
 #include <memory>
+#include <unordered_set>
+#include <cstdlib>
 
 #include "htslib/vcf.h"
 #include "htslib/sam.h"
@@ -23,9 +25,11 @@ struct region_t {
 
 class seq {
     public:
-    seq(const std::string &n, const std::string &s): name(n), sequence(s){};
+    seq(const std::string &n, const std::string &s, const std::string &q):
+        name(n), sequence(s), qname(q){};
     std::string name;
     std::string sequence;
+    std::string qname;
     // void print() {
     //     std::cout << ">" << name << std::endl;
     //     std::cout << sequence << std::endl;
@@ -35,8 +39,9 @@ class seq {
 class ins {
     public:
         ins() = default;
+        // max_reads caps the sequences used for consensus, 0 for no cap
         ins(bcf_hdr_t *vcf_h, bcf1_t *vcf_v, samFile *sam_fp,
-            bam_hdr_t *bam_h, hts_idx_t *bam_idx);
+            bam_hdr_t *bam_h, hts_idx_t *bam_idx, std::size_t max_reads = 0);
 
         std::string chrom;
         uint32_t pos;
@@ -61,6 +66,9 @@ class ins {
         std::shared_ptr<seq> get_ins_sequence(bam_hdr_t *h, bam1_t *b);
         std::vector<std::shared_ptr<seq>> get_ins_sequences(samFile *fp,
             bam_hdr_t *h, const hts_idx_t *bam_idx);
+        std::vector<std::shared_ptr<seq>> select_sequences(
+            const std::vector<std::shared_ptr<seq>> &seqs,
+            std::size_t max_reads);
         std::string get_consensus();
 };
 
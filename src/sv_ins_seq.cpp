@@ -3,10 +3,22 @@
 int main(int argc, char const *argv[]) {
     if (argc < 3) {
         std::cerr << 
-            "Usage: sv_ins_seq <vcf> <bam> 1> ins.seq.fasta 2> error.log"
+            "Usage: sv_ins_seq <vcf> <bam> [max_reads] 1> ins.seq.fasta "
+            "2> error.log\n"
+            "  max_reads: max insert sequences per INS used for consensus, "
+            "0 for all [0]"
             << std::endl;
         std::exit(1);
     }
+    std::size_t max_reads = 0;
+    if (argc > 3) {
+        if (!IsUnsigned(argv[3])) {
+            std::cerr << "[sv_ins_seq::Error]: max_reads must be a "
+                "non-negative integer, got " << argv[3] << std::endl;
+            std::exit(1);
+        }
+        max_reads = std::stoul(argv[3]);
+    }
 
     vcfFile *fp_v = vcf_open(argv[1], "r");
     bcf_hdr_t *h_v = bcf_hdr_read(fp_v);
@@ -35,7 +47,7 @@ int main(int argc, char const *argv[]) {
         std::string svtype_string = svtype;
         free(svtype);
         if (svtype_string == "INS") {
-            ins _ins(h_v, v, fp_b, h_b, idx_b);
+            ins _ins(h_v, v, fp_b, h_b, idx_b, max_reads);
             if (_ins.consensus.begin() != _ins.consensus.end()) {
                 std::cout << ">" << _ins.id << std::endl;
                 std::cout << _ins.consensus << std::endl; 
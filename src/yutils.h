@@ -19,4 +19,11 @@ void Tokenize(const std::string &str, std::vector<std::string> &elems,
     }
 }
 
+// true if str is a non-empty string of digits
+inline
+bool IsUnsigned(const std::string &str) {
+    return !str.empty() && str.size() < 19 &&
+        str.find_first_not_of("0123456789") == std::string::npos;
+}
+
 #endif // YUTILS_H 
\ No newline at end of file
@@ -0,0 +1,79 @@
+"""
+tabix indexes of vcf_reader and table_writer against htslib.
+
+data/tabix.vcf.gz was written by table_writer, data/tabix.vcf.gz.tbi was
+made from it by htslib with the vcf preset, as tabix -p vcf.
+"""
+import os
+import sys
+import gzip
+import shutil
+import struct
+
+import pytest
+
+TESTS = os.path.dirname(os.path.abspath(__file__))
+DATA = os.path.join(TESTS, "data")
+sys.path.insert(0, os.path.join(os.path.dirname(TESTS), "scripts"))
+
+import table_writer
+import vcf_reader
+
+VCF = os.path.join(DATA, "tabix.vcf.gz")
+REGIONS = ["1", "1:1730354-1730354", "1:16384-16385", "1:100000-250000",
+    "1:2000000-2600000", "1:3300000-", "2:450000-520000", "2:1-899999",
+    "X:1-1200000", "X:2300000-3000000", "Y"]
+
+
+def records(vcf):
+    with gzip.open(vcf, "rt") as io:
+        return [i for i in io if i[0] != "#"]
+
+
+def tbi_content(tbi):
+    """
+    header, n_no_coor, bins and linear index of each sequence of a .tbi.
+    htslib writes bins in hash order, so they are compared as dicts.
+    """
+    with gzip.open(tbi, "rb") as io:
+        data = io.read()
+    l_nm = struct.unpack_from("<i", data, 32)[0]
+    index = vcf_reader.tabix_index(tbi)
+    return data[:36+l_nm], data[-8:], index.bins, index.ioffs
+
+
+def test_read_htslib_index(tmp_path):
+    seek_vcf = str(tmp_path / "seek.vcf.gz")
+    stream_vcf = str(tmp_path / "stream.vcf.gz")
+    shutil.copy(VCF, seek_vcf)
+    shutil.copy(VCF, stream_vcf)
+    # the index must not be older than the vcf to be used
+    shutil.copy(VCF + ".tbi", seek_vcf + ".tbi")
+    lines = records(VCF)
+    for region in REGIONS:
+        chrom, start, end = vcf_reader.parse_region(region)
+        expected = [i for i in lines if i.split("\t")[0] == chrom and
+            start <= int(i.split("\t")[1]) <= end]
+        reader = vcf_reader.vcf_reader(seek_vcf, [(chrom, start, end)])
+        assert reader.tbi is not None
+        seek = [i for i in reader if i[0] != "#"]
+        stream = [i for i in vcf_reader.vcf_reader(stream_vcf,
+            [(chrom, start, end)]) if i[0] != "#"]
+        assert seek == expected, region
+        assert stream == expected, region
+
+
+def test_write_htslib_index(tmp_path):
+    out = str(tmp_path / "out.vcf.gz")
+    with gzip.open(VCF, "rt") as io, table_writer.table_writer(out,
+        table_writer.TABIX_VCF) as writer:
+        for line in io:
+            if line[0] == "#":
+                writer.write(line)
+            else:
+                writer.write_lines([line])
+    with open(out, "rb") as io, open(VCF, "rb") as expected:
+        if io.read() != expected.read():
+            # virtual offsets of the fixture index only hold for its blocks
+            pytest.skip("zlib compresses differently from the fixture")
+    assert tbi_content(out + ".tbi") == tbi_content(VCF + ".tbi")